@@ -1,13 +1,25 @@
 import logging
 import RHUtils
 import json
+import math
 import requests
 from eventmanager import Evt
 import Config
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
+import sys
 import struct
+import os
+import mmap
+import heapq
+from bisect import bisect_left
+from collections import deque
+from array import array
 from time import monotonic
+from datetime import datetime
 from Database import ProgramMethod
+from flask import current_app, request, has_request_context
+import gevent.event
+import gevent.local
 import gevent.monkey
 gevent.monkey.patch_all()
 
@@ -24,12 +36,58 @@ LAP_DELAY_TIME_INPUT = "FSLapDelayTime"
 RACE_COOLDOWN_TIME_INPUT = "FSRaceCooldown"
 APPLY_INPUT = "FSApply"
 HEAT_LOCK_INPUT = "FSHeatLockInput"
+LOBBY_SIZE_INPUT = "FSLobbySize"
+SPECTATOR_TICK_RATE_INPUT = "FSSpectatorTickRate"
+SPECTATOR_BUFFER_INPUT = "FSSpectatorBuffer"
+WIRE_FORMAT_INPUT = "FSWireFormat"
+KEYFRAME_INTERVAL_INPUT = "FSKeyframeInterval"
+UI_BROADCAST_WINDOW_INPUT = "FSUIBroadcastWindow"
+GATE_MODE_INPUT = "FSGateMode"
+EXTRAPOLATION_INPUT = "FSExtrapolation"
 
 
 STEAM_ID = "SteamID"
 UPDATE_TIMEOUT = 5
 MAX_PLAYERS = 8
-MAX_SPECTATORS = 8
+MAX_SPECTATORS = 32
+
+#socket.io rooms for the two state stream tiers
+PILOT_ROOM = "fs_pilots"
+SPECTATOR_ROOM = "fs_spectators"
+
+#wire formats for the fs state stream
+WIRE_FORMAT_JSON = "json"
+WIRE_FORMAT_BINARY = "binary"
+
+#server side lap detection. crosscheck only compares server detected crossings with client laps, replace counts them instead of client laps
+GATE_MODE_OFF = "off"
+GATE_MODE_CROSSCHECK = "crosscheck"
+GATE_MODE_REPLACE = "replace"
+
+#dead reckoning. seats are extrapolated from a least squares fit of their last few samples, up to the extrapolation limit past the newest one
+MOTION_HISTORY_DEPTH = 4
+MOTION_MIN_SPAN = 0.02
+MOTION_MAX_SPEED = 150.0
+MOTION_MAX_ANGULAR_RATE = 2000.0
+
+#snapshot deltas
+SNAPSHOT_RING_SIZE = 64
+DELTA_POSITION_THRESHOLD = 0.01
+DELTA_ORIENTATION_THRESHOLD = 0.5
+
+#clock sync. pilots are pinged through their room and answer with their own clock, laps are held just long enough for the slowest connected seat
+CLOCK_PING_INTERVAL = 2.0
+CLOCK_SYNC_PING_INTERVAL = 0.25
+CLOCK_SAMPLE_WINDOW = 8
+CLOCK_MIN_SAMPLES = 3
+CLOCK_JITTER_FACTOR = 4
+CLOCK_SAFETY_MARGIN = 0.02
+
+#upper bounds of the latency histogram buckets, anything above the last bucket is counted as overflow
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+#RotorHazard UI views the broadcast coalescer can send, in the order they are flushed
+UI_VIEWS = ["pilots", "raceclasses", "heats", "current_heat", "race_status"]
 
 #default values
 DEFAULT_AUTO_RUN = "0"
@@ -40,6 +98,14 @@ DEFAULT_TRACK = "The Shrine"
 DEFAULT_LAP_DELAY_TIME = 999
 DEFAULT_RACE_COOLDOWN_TIME = 30
 DEFAULT_HEAT_LOCK = "0"
+DEFAULT_LOBBY_SIZE = MAX_PLAYERS
+DEFAULT_SPECTATOR_TICK_RATE = 5
+DEFAULT_SPECTATOR_BUFFER = 300
+DEFAULT_WIRE_FORMAT = WIRE_FORMAT_JSON
+DEFAULT_KEYFRAME_INTERVAL = 30
+DEFAULT_UI_BROADCAST_WINDOW = 250
+DEFAULT_GATE_MODE = GATE_MODE_OFF
+DEFAULT_EXTRAPOLATION = 150
 DEFAULTS = {
     SERVER_TICK_RATE_INPUT: DEFAULT_SERVER_TICK_RATE,
     AUTO_RUN_INPUT: DEFAULT_AUTO_RUN,
@@ -48,9 +114,202 @@ DEFAULTS = {
     TRACK_INPUT: DEFAULT_TRACK,
     LAP_DELAY_TIME_INPUT: DEFAULT_LAP_DELAY_TIME,
     RACE_COOLDOWN_TIME_INPUT: DEFAULT_RACE_COOLDOWN_TIME,
-    HEAT_LOCK_INPUT: DEFAULT_HEAT_LOCK
+    HEAT_LOCK_INPUT: DEFAULT_HEAT_LOCK,
+    LOBBY_SIZE_INPUT: DEFAULT_LOBBY_SIZE,
+    SPECTATOR_TICK_RATE_INPUT: DEFAULT_SPECTATOR_TICK_RATE,
+    SPECTATOR_BUFFER_INPUT: DEFAULT_SPECTATOR_BUFFER,
+    WIRE_FORMAT_INPUT: DEFAULT_WIRE_FORMAT,
+    KEYFRAME_INTERVAL_INPUT: DEFAULT_KEYFRAME_INTERVAL,
+    UI_BROADCAST_WINDOW_INPUT: DEFAULT_UI_BROADCAST_WINDOW,
+    GATE_MODE_INPUT: DEFAULT_GATE_MODE,
+    EXTRAPOLATION_INPUT: DEFAULT_EXTRAPOLATION
 }
 
+#how each option is parsed when it is loaded into the option cache
+OPTION_TYPES = {
+    SERVER_TICK_RATE_INPUT: int,
+    AUTO_RUN_INPUT: bool,
+    CLIENT_TICK_RATE_INPUT: int,
+    CLIENT_JITTER_COMP_INPUT: float,
+    TRACK_INPUT: str,
+    LAP_DELAY_TIME_INPUT: int,
+    RACE_COOLDOWN_TIME_INPUT: int,
+    HEAT_LOCK_INPUT: bool,
+    LOBBY_SIZE_INPUT: int,
+    SPECTATOR_TICK_RATE_INPUT: int,
+    SPECTATOR_BUFFER_INPUT: int,
+    WIRE_FORMAT_INPUT: str,
+    KEYFRAME_INTERVAL_INPUT: int,
+    UI_BROADCAST_WINDOW_INPUT: int,
+    GATE_MODE_INPUT: str,
+    EXTRAPOLATION_INPUT: int
+}
+
+#binary snapshot layout (little endian)
+#header: magic, version, flags, sequence, baseline sequence, server time, seat count, presence bitmask, changed bitmask
+#seat record (one per seat that is both present and changed, in seat order): position in mm, orientation in quantized degrees, rssi, staleness in ms
+#keyframes mark every seat as changed. deltas only carry seats that moved since the baseline, a changed seat that is no longer present has left
+FS_WIRE_MAGIC = b"FS"
+FS_WIRE_VERSION = 3
+FS_FLAG_KEYFRAME = 0x01
+FS_FLAG_REPLAY = 0x02
+FS_HEADER = struct.Struct("<2sBBIIdBII")
+FS_SEAT = struct.Struct("<3i3hHH")
+FS_POSITION_SCALE = 1000.0
+FS_ORIENTATION_SCALE = 32767/180.0
+FS_MAX_WIRE_SEATS = 32
+FS_MAX_POSITION = 2**31-1
+
+def quantizePosition(value):
+    #millimetres in a signed int, anything further out than ~2147 km is pinned to the edge
+    return max(-FS_MAX_POSITION, min(FS_MAX_POSITION, int(round(value*FS_POSITION_SCALE))))
+
+def quantizeAngle(angle):
+    #wrap to [-180, 180) so the angle fits in a signed short
+    angle = ((angle+180.0)%360.0)-180.0
+    return max(-32767, min(32767, int(round(angle*FS_ORIENTATION_SCALE))))
+
+def encodeSnapshot(time, store, sequence, baseline=0, changed=None, flags=0):
+    #reads seats straight from a FSSeatStore. a changed mask of None encodes a keyframe
+    if(changed==None):
+        changed = (1<<store.size)-1
+        flags |= FS_FLAG_KEYFRAME
+
+    presence = 0
+    count = 0
+    for seat in range(0, store.size):
+        if(store.present[seat]):
+            presence |= 1<<seat
+            if(changed & (1<<seat)):
+                count += 1
+
+    payload = bytearray(FS_HEADER.size+count*FS_SEAT.size)
+    FS_HEADER.pack_into(payload, 0, FS_WIRE_MAGIC, FS_WIRE_VERSION, flags, sequence, baseline, time, store.size, presence, changed)
+    offset = FS_HEADER.size
+    position = store.position
+    orientation = store.orientation
+    for seat in range(0, store.size):
+        if(presence & changed & (1<<seat)):
+            index = seat*3
+            FS_SEAT.pack_into(payload, offset,
+                quantizePosition(position[index]), quantizePosition(position[index+1]), quantizePosition(position[index+2]),
+                quantizeAngle(orientation[index]), quantizeAngle(orientation[index+1]), quantizeAngle(orientation[index+2]),
+                max(0, min(65535, store.rssi[seat])), max(0, min(65535, int(store.staleness[seat]))))
+            offset += FS_SEAT.size
+    return bytes(payload)
+
+def decodeSnapshot(payload):
+    magic, version, flags, sequence, baseline, time, seatCount, presence, changed = FS_HEADER.unpack_from(payload, 0)
+    if(magic!=FS_WIRE_MAGIC or version!=FS_WIRE_VERSION):
+        raise ValueError("unsupported snapshot encoding "+str(magic)+" v"+str(version))
+
+    states = {}
+    offset = FS_HEADER.size
+    for seat in range(0, seatCount):
+        if(not changed & (1<<seat)):
+            continue
+        if(presence & (1<<seat)):
+            px, py, pz, ox, oy, oz, rssi, staleness = FS_SEAT.unpack_from(payload, offset)
+            offset += FS_SEAT.size
+            states[seat] = {"seat": seat,
+                "position":[px/FS_POSITION_SCALE, py/FS_POSITION_SCALE, pz/FS_POSITION_SCALE],
+                "orientation":[ox/FS_ORIENTATION_SCALE, oy/FS_ORIENTATION_SCALE, oz/FS_ORIENTATION_SCALE],
+                "rssi":rssi, "staleness":staleness}
+        else:
+            states[seat] = {"seat": -1, "position":[0,-100,0], "orientation":[0,0,0], "rssi":0, "staleness":0}
+
+    #mirror the JSON snapshot shapes
+    if(flags & FS_FLAG_KEYFRAME):
+        snapshot = {"time":time, "sequence":sequence, "keyframe":True, "states":[states[seat] for seat in range(0, seatCount)]}
+        if(flags & FS_FLAG_REPLAY):
+            snapshot["replay"] = True
+        return snapshot
+    return {"time":time, "sequence":sequence, "baseline":baseline, "keyframe":False, "delta":states}
+
+#race recording layout (little endian)
+#file header: magic, version, seat count, reserved, wall clock start time
+#record (one per server tick): seconds since the recording started, snapshot sequence, presence bitmask,
+#followed by every seat, present or not: position, orientation (float32) and rssi
+FSR_MAGIC = b"FSRC"
+FSR_VERSION = 1
+FSR_HEADER = struct.Struct("<4sBBHd")
+FSR_RECORD_HEADER = struct.Struct("<dII")
+FSR_SEAT = struct.Struct("<3f3fH")
+RECORDING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+RECORDING_INDEX = "index.json"
+RECORDING_FLUSH_INTERVAL = 1.0
+#replay frames are numbered from here so they can never be mistaken for live snapshot sequences
+REPLAY_SEQUENCE_BASE = 2**31
+
+#start/finish gate geometry per track: {"track name": {"center":[x,y,z], "normal":[x,y,z], "width":w, "height":h, "up":[x,y,z]}}
+#the normal points in the racing direction, up is optional and defaults to world up
+GATES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gates.json")
+GATE_MIN_LAP_TIME = 2.0
+GATE_MAX_STEP = 50.0
+#position samples kept per seat between two gate checks, the oldest are dropped if a seat sends more than this in one tick
+GATE_SAMPLE_BUFFER = 32
+GATE_CROSSCHECK_WINDOW = 0.5
+
+#instrumentation
+METRICS_PANEL_NAME = "FlowStateMetrics"
+METRICS_REFRESH_INPUT = "FSMetricsRefresh"
+TRAFFIC_SAMPLE_RATE = 16
+PROFILER_INTERVAL = 0.005
+PROFILER_STACK_DEPTH = 3
+
+def normalize(vector):
+    length = (vector[0]**2+vector[1]**2+vector[2]**2)**0.5
+    if(length==0):
+        raise ValueError("zero length vector")
+    return [vector[0]/length, vector[1]/length, vector[2]/length]
+
+def cross(a, b):
+    return [a[1]*b[2]-a[2]*b[1], a[2]*b[0]-a[0]*b[2], a[0]*b[1]-a[1]*b[0]]
+
+def parseGate(data):
+    #gate plane with an orthonormal basis: normal is the racing direction, right and up span the opening
+    normal = normalize(data["normal"])
+    right = normalize(cross(data.get("up", [0.0, 1.0, 0.0]), normal))
+    return {"center":[float(value) for value in data["center"]], "normal":normal, "right":right, "up":cross(normal, right),
+        "halfWidth":float(data["width"])/2, "halfHeight":float(data["height"])/2}
+
+def loadGates(path):
+    gates = {}
+    if(not os.path.exists(path)):
+        return gates
+    try:
+        with open(path) as gatesFile:
+            data = json.load(gatesFile)
+    except (OSError, ValueError) as error:
+        logging.info("could not read gate geometry from "+path+": "+str(error))
+        return gates
+    for track, gate in data.items():
+        try:
+            gates[track] = parseGate(gate)
+        except (KeyError, TypeError, ValueError) as error:
+            logging.info("invalid gate geometry for track "+str(track)+": "+str(error))
+    return gates
+
+def payloadSize(payload):
+    #wire size of a socket payload, JSON payloads are measured as compact JSON
+    if(isinstance(payload, (bytes, bytearray))):
+        return len(payload)
+    return len(json.dumps(payload, separators=(",", ":")))
+
+def seatChanged(current, baseline, seat):
+    #true if a seat moved, turned or changed rssi/presence beyond the delta thresholds
+    if(current.present[seat]!=baseline.present[seat]):
+        return True
+    if(not current.present[seat]):
+        return False
+    index = seat*3
+    for axis in range(index, index+3):
+        if(abs(current.position[axis]-baseline.position[axis])>DELTA_POSITION_THRESHOLD):
+            return True
+        if(abs(((current.orientation[axis]-baseline.orientation[axis]+180.0)%360.0)-180.0)>DELTA_ORIENTATION_THRESHOLD):
+            return True
+    return current.rssi[seat]!=baseline.rssi[seat]
+
 def initialize(rhapi):
     RH = FSManager(rhapi)
 
@@ -58,6 +317,9 @@ def initialize(rhapi):
     
     rhapi.ui.register_panel(PANEL_NAME, 'FlowState', 'run', order=0)
 
+    serverTickRateField = UIField(name = SERVER_TICK_RATE_INPUT, label = 'Server Tick Rate', field_type = UIFieldType.BASIC_INT, value = DEFAULT_SERVER_TICK_RATE)
+    rhapi.fields.register_option(serverTickRateField, PANEL_NAME)
+
     clientTickRateField = UIField(name = CLIENT_TICK_RATE_INPUT, label = 'Client Tick Rate', field_type = UIFieldType.BASIC_INT, value = DEFAULT_CLIENT_TICK_RATE)
     rhapi.fields.register_option(clientTickRateField, PANEL_NAME)
 
@@ -73,56 +335,1706 @@ def initialize(rhapi):
     raceCooldown = UIField(name = RACE_COOLDOWN_TIME_INPUT, label = 'Race Cooldown Time', field_type = UIFieldType.BASIC_INT, value = DEFAULT_RACE_COOLDOWN_TIME)
     rhapi.fields.register_option(raceCooldown, PANEL_NAME)
 
+    lobbySize = UIField(name = LOBBY_SIZE_INPUT, label = 'Lobby Size (limited to the number of RotorHazard nodes)', field_type = UIFieldType.BASIC_INT, value = DEFAULT_LOBBY_SIZE)
+    rhapi.fields.register_option(lobbySize, PANEL_NAME)
+
+    spectatorTickRate = UIField(name = SPECTATOR_TICK_RATE_INPUT, label = 'Spectator Tick Rate', field_type = UIFieldType.BASIC_INT, value = DEFAULT_SPECTATOR_TICK_RATE)
+    rhapi.fields.register_option(spectatorTickRate, PANEL_NAME)
+
+    spectatorBuffer = UIField(name = SPECTATOR_BUFFER_INPUT, label = 'Spectator Interpolation Buffer Ms (0 to use client smoothing)', field_type = UIFieldType.BASIC_INT, value = DEFAULT_SPECTATOR_BUFFER)
+    rhapi.fields.register_option(spectatorBuffer, PANEL_NAME)
+
     lockHeat = UIField(name = HEAT_LOCK_INPUT, label = 'Lock Heat (prevent player from joining/leaving heats)', field_type = UIFieldType.CHECKBOX, value = DEFAULT_HEAT_LOCK)
     rhapi.fields.register_option(lockHeat, PANEL_NAME)
 
+    wireFormat = UIField(name = WIRE_FORMAT_INPUT, label = 'State Wire Format (clients without binary support fall back to JSON)', field_type = UIFieldType.SELECT, value = DEFAULT_WIRE_FORMAT, options = [UIFieldSelectOption(WIRE_FORMAT_JSON, 'JSON'), UIFieldSelectOption(WIRE_FORMAT_BINARY, 'Binary')])
+    rhapi.fields.register_option(wireFormat, PANEL_NAME)
+
+    keyframeInterval = UIField(name = KEYFRAME_INTERVAL_INPUT, label = 'Keyframe Interval (server ticks between full state snapshots)', field_type = UIFieldType.BASIC_INT, value = DEFAULT_KEYFRAME_INTERVAL)
+    rhapi.fields.register_option(keyframeInterval, PANEL_NAME)
+
+    uiBroadcastWindow = UIField(name = UI_BROADCAST_WINDOW_INPUT, label = 'UI Update Window Ms (pilot and heat list updates are grouped within this window)', field_type = UIFieldType.BASIC_INT, value = DEFAULT_UI_BROADCAST_WINDOW)
+    rhapi.fields.register_option(uiBroadcastWindow, PANEL_NAME)
+
+    gateMode = UIField(name = GATE_MODE_INPUT, label = 'Server Lap Detection (needs gate geometry for the track in gates.json)', field_type = UIFieldType.SELECT, value = DEFAULT_GATE_MODE, options = [UIFieldSelectOption(GATE_MODE_OFF, 'Off'), UIFieldSelectOption(GATE_MODE_CROSSCHECK, 'Cross-check Client Laps'), UIFieldSelectOption(GATE_MODE_REPLACE, 'Replace Client Laps')])
+    rhapi.fields.register_option(gateMode, PANEL_NAME)
+
+    extrapolation = UIField(name = EXTRAPOLATION_INPUT, label = 'Server Extrapolation Limit Ms (0 to send the last received state)', field_type = UIFieldType.BASIC_INT, value = DEFAULT_EXTRAPOLATION)
+    rhapi.fields.register_option(extrapolation, PANEL_NAME)
+
     autoRun = UIField(name = AUTO_RUN_INPUT, label = 'Auto Run Next Heat', field_type = UIFieldType.CHECKBOX, value = DEFAULT_AUTO_RUN)
     rhapi.fields.register_option(autoRun, PANEL_NAME)
     
     rhapi.ui.register_quickbutton(PANEL_NAME, APPLY_INPUT, 'Apply', RH.apply)
+    rhapi.ui.register_quickbutton(PANEL_NAME, METRICS_REFRESH_INPUT, 'Refresh Metrics', RH.refreshMetricsPanel)
+    rhapi.ui.register_markdown(PANEL_NAME, METRICS_PANEL_NAME, RH.renderMetrics())
 
     #data attributes
     pilotSteamID = UIField(name = STEAM_ID, label = "Steam ID", field_type = UIFieldType.TEXT)
     rhapi.fields.register_pilot_attribute(pilotSteamID)
 
     RH.loadDefaults()
+
+    #server lifecycle
+    rhapi.events.on(Evt.STARTUP, RH.startup)
+    rhapi.events.on(Evt.SHUTDOWN, RH.shutdown)
+    rhapi.events.on(Evt.OPTION_SET, RH.handleOptionSet)
+
+    #heat management reacts to race status changes instead of running on every state packet
+    rhapi.events.on(Evt.RACE_STOP, RH.handleRaceStop)
+    rhapi.events.on(Evt.RACE_FINISH, RH.handleRaceStatusChanged)
+    rhapi.events.on(Evt.RACE_PILOT_DONE, RH.handleRaceStatusChanged)
+
+    #race recording. replays give way to a live race as soon as it is staged
+    rhapi.events.on(Evt.RACE_STAGE, RH.handleRaceStage)
+    rhapi.events.on(Evt.RACE_START, RH.handleRaceStart)
+    rhapi.events.on(Evt.LAPS_SAVE, RH.handleLapsSave)
+
+    #keep the pilot index current
+    rhapi.events.on(Evt.PILOT_ADD, RH.handlePilotChanged)
+    rhapi.events.on(Evt.PILOT_ALTER, RH.handlePilotChanged)
+    rhapi.events.on(Evt.PILOT_DELETE, RH.handlePilotDeleted)
+    rhapi.events.on(Evt.DATABASE_RESET, RH.rebuildPilotIndex)
+    rhapi.events.on(Evt.DATABASE_RECOVER, RH.rebuildPilotIndex)
+    rhapi.events.on(Evt.DATABASE_RESTORE, RH.rebuildPilotIndex)
     
     logging.info("--------------FLOW STATE INITIALIZED--------------")
 
-class FSManager():
+class FSSeatStore():
+    #preallocated per seat state. packets update fields in place and snapshots are serialized straight from the arrays
+    def __init__(self, size):
+        self.size = size
+        self.present = array("B", [0])*size
+        self.position = array("d", [0.0, -100.0, 0.0])*size
+        self.orientation = array("d", [0.0])*(3*size)
+        self.rssi = array("i", [0])*size
+        self.pilotIds = array("i", [0])*size
+        self.updateTimes = array("d", [0.0])*size
+        #ms between a seat's newest sample and the time the snapshot is for
+        self.staleness = array("d", [0.0])*size
+
+        #JSON views of each seat, refreshed in place when a JSON snapshot is built
+        self.jsonStates = []
+        for seat in range(0, size):
+            self.jsonStates.append({"seat": -1, "position":[0,-100,0], "orientation":[0,0,0], "rssi":0, "pilotId":0, "staleness":0})
+
+    def update(self, seat, data, now):
+        #returns False and leaves the seat untouched if the state has values that can't be encoded
+        position = data["position"]
+        orientation = data["orientation"]
+        rssi = data["rssi"]
+        for value in (position[0], position[1], position[2], orientation[0], orientation[1], orientation[2], rssi):
+            if(not math.isfinite(value)):
+                return False
+        index = seat*3
+        self.position[index] = position[0]
+        self.position[index+1] = position[1]
+        self.position[index+2] = position[2]
+        self.orientation[index] = orientation[0]
+        self.orientation[index+1] = orientation[1]
+        self.orientation[index+2] = orientation[2]
+        self.rssi[seat] = int(rssi)
+        self.pilotIds[seat] = data.get("pilotId") or 0
+        self.updateTimes[seat] = now
+        self.present[seat] = 1
+        return True
+
+    def clear(self, seat):
+        index = seat*3
+        self.position[index] = 0.0
+        self.position[index+1] = -100.0
+        self.position[index+2] = 0.0
+        self.orientation[index] = 0.0
+        self.orientation[index+1] = 0.0
+        self.orientation[index+2] = 0.0
+        self.rssi[seat] = 0
+        self.pilotIds[seat] = 0
+        self.staleness[seat] = 0.0
+        self.present[seat] = 0
+
+    def copy(self):
+        #frozen copy of the numeric state for the snapshot ring
+        snapshot = FSSeatStore(0)
+        snapshot.size = self.size
+        snapshot.present = self.present[:]
+        snapshot.position = self.position[:]
+        snapshot.orientation = self.orientation[:]
+        snapshot.rssi = self.rssi[:]
+        snapshot.pilotIds = self.pilotIds[:]
+        snapshot.updateTimes = self.updateTimes[:]
+        snapshot.staleness = self.staleness[:]
+        return snapshot
+
+    def copySeat(self, source, seat):
+        #take one seat's numeric state from another store
+        index = seat*3
+        self.position[index:index+3] = source.position[index:index+3]
+        self.orientation[index:index+3] = source.orientation[index:index+3]
+        self.rssi[seat] = source.rssi[seat]
+        self.pilotIds[seat] = source.pilotIds[seat]
+        self.updateTimes[seat] = source.updateTimes[seat]
+        self.staleness[seat] = source.staleness[seat]
+        self.present[seat] = source.present[seat]
+
+    def jsonState(self, seat):
+        state = self.jsonStates[seat]
+        position = state["position"]
+        orientation = state["orientation"]
+        index = seat*3
+        if(self.present[seat]):
+            state["seat"] = seat
+        else:
+            state["seat"] = -1
+        position[0] = self.position[index]
+        position[1] = self.position[index+1]
+        position[2] = self.position[index+2]
+        orientation[0] = self.orientation[index]
+        orientation[1] = self.orientation[index+1]
+        orientation[2] = self.orientation[index+2]
+        state["rssi"] = self.rssi[seat]
+        state["pilotId"] = self.pilotIds[seat]
+        state["staleness"] = int(self.staleness[seat])
+        return state
+
+    def jsonStateList(self):
+        for seat in range(0, self.size):
+            self.jsonState(seat)
+        return self.jsonStates
+
+def wrapAngle(angle):
+    return ((angle+180.0)%360.0)-180.0
+
+class FSMotionHistory():
+    #the last few timestamped samples of every seat in flat ring buffers, used to extrapolate all seats to the tick time in one pass
+    def __init__(self, size):
+        self.size = size
+        self.times = array("d", [0.0])*(MOTION_HISTORY_DEPTH*size)
+        self.positions = array("d", [0.0])*(3*MOTION_HISTORY_DEPTH*size)
+        self.orientations = array("d", [0.0])*(3*MOTION_HISTORY_DEPTH*size)
+        self.counts = array("B", [0])*size
+        self.heads = array("B", [0])*size
+
+    def record(self, seat, position, orientation, time):
+        slot = seat*MOTION_HISTORY_DEPTH+self.heads[seat]
+        self.times[slot] = time
+        index = slot*3
+        for axis in range(0, 3):
+            self.positions[index+axis] = position[axis]
+            self.orientations[index+axis] = orientation[axis]
+        self.heads[seat] = (self.heads[seat]+1)%MOTION_HISTORY_DEPTH
+        self.counts[seat] = min(MOTION_HISTORY_DEPTH, self.counts[seat]+1)
+
+    def reset(self, seat):
+        self.counts[seat] = 0
+        self.heads[seat] = 0
+
+    def rates(self, seat):
+        #least squares velocity and angular rate over the seat's history, None if there isn't enough of it to trust
+        count = self.counts[seat]
+        if(count<2):
+            return None
+        base = seat*MOTION_HISTORY_DEPTH
+        newest = base+(self.heads[seat]-1)%MOTION_HISTORY_DEPTH
+        slots = [base+(self.heads[seat]-1-i)%MOTION_HISTORY_DEPTH for i in range(0, count)]
+        times = self.times
+        meanTime = sum([times[slot] for slot in slots])/count
+        spread = sum([(times[slot]-meanTime)**2 for slot in slots])
+        if(times[newest]-times[slots[-1]]<MOTION_MIN_SPAN or spread==0):
+            return None
+
+        rates = [0.0]*6
+        for axis in range(0, 3):
+            meanPosition = sum([self.positions[slot*3+axis] for slot in slots])/count
+            rates[axis] = sum([(times[slot]-meanTime)*(self.positions[slot*3+axis]-meanPosition) for slot in slots])/spread
+            #angles are unwrapped around the newest sample so a turn through +-180 isn't a spin
+            reference = self.orientations[newest*3+axis]
+            angles = [reference+wrapAngle(self.orientations[slot*3+axis]-reference) for slot in slots]
+            meanAngle = sum(angles)/count
+            rates[3+axis] = sum([(times[slot]-meanTime)*(angles[i]-meanAngle) for i, slot in enumerate(slots)])/spread
+
+        #respawns and resets look like impossible speeds, those seats are sent as they are
+        if(rates[0]**2+rates[1]**2+rates[2]**2>MOTION_MAX_SPEED**2):
+            return None
+        if(max(abs(rates[3]), abs(rates[4]), abs(rates[5]))>MOTION_MAX_ANGULAR_RATE):
+            return None
+        return rates
+
+    def apply(self, source, target, now, limit):
+        #writes every seat of source into target extrapolated to now, returns how many seats will keep moving on the next tick
+        moving = 0
+        for seat in range(0, self.size):
+            index = seat*3
+            target.present[seat] = source.present[seat]
+            target.rssi[seat] = source.rssi[seat]
+            target.pilotIds[seat] = source.pilotIds[seat]
+            target.updateTimes[seat] = source.updateTimes[seat]
+            for axis in range(0, 3):
+                target.position[index+axis] = source.position[index+axis]
+                target.orientation[index+axis] = source.orientation[index+axis]
+            if(not source.present[seat]):
+                target.staleness[seat] = 0.0
+                continue
+
+            age = max(0.0, now-source.updateTimes[seat])
+            target.staleness[seat] = age*1000
+            if(limit<=0):
+                continue
+            rates = self.rates(seat)
+            if(rates==None):
+                continue
+            dt = min(age, limit)
+            if(age<limit):
+                moving += 1
+            for axis in range(0, 3):
+                target.position[index+axis] = source.position[index+axis]+rates[axis]*dt
+                target.orientation[index+axis] = wrapAngle(source.orientation[index+axis]+rates[3+axis]*dt)
+        return moving
+
+class FSRecordingIndex():
+    #recording lookup by id, heat and saved race id, kept as json next to the recordings
+    def __init__(self, directory):
+        self.path = os.path.join(directory, RECORDING_INDEX)
+        self.recordings = []
+        if(os.path.exists(self.path)):
+            try:
+                with open(self.path, "r") as indexFile:
+                    self.recordings = json.load(indexFile)["recordings"]
+            except (OSError, ValueError, KeyError):
+                logging.info("could not read recording index "+self.path+", starting a new one")
+
+    def save(self):
+        with open(self.path, "w") as indexFile:
+            json.dump({"recordings":self.recordings}, indexFile)
+
+    def nextId(self):
+        nextId = 1
+        for recording in self.recordings:
+            nextId = max(nextId, recording["id"]+1)
+        return nextId
+
+    def add(self, recording):
+        self.recordings.append(recording)
+        self.save()
+
+    def find(self, recordingId=None, raceId=None):
+        for recording in reversed(self.recordings):
+            if(recordingId!=None and recording["id"]==recordingId):
+                return recording
+            if(raceId!=None and recording["raceId"]==raceId):
+                return recording
+        return None
+
+class FSRaceRecorder():
+    #appends one fixed size record per server tick to a per heat file. records are buffered on the tick
+    #and written by a writer greenlet through the gevent threadpool, so neither the tick nor the state handler waits on disk
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = None
+        self.recording = None
+        self.lastRecording = None
+        self.file = None
+        self.buffer = bytearray()
+        self.blankRecord = b""
+        self.seatCount = 0
+        self.startTime = 0.0
+        self.stopping = False
+        self.wakeup = gevent.event.Event()
+        self.writer = None
+
+    def loadIndex(self):
+        if(self.index==None):
+            os.makedirs(self.directory, exist_ok=True)
+            self.index = FSRecordingIndex(self.directory)
+        return self.index
+
+    def start(self, heatId, seatCount, now):
+        if(self.recording!=None):
+            self.stop()
+        #let the previous writer finish with its file before the buffer is reused
+        if(self.writer!=None):
+            self.writer.join()
+        index = self.loadIndex()
+        recordingId = index.nextId()
+        fileName = "race_"+str(recordingId)+".fsr"
+        startTime = datetime.now()
+        self.file = open(os.path.join(self.directory, fileName), "wb")
+        self.file.write(FSR_HEADER.pack(FSR_MAGIC, FSR_VERSION, seatCount, 0, startTime.timestamp()))
+        self.recording = {"id":recordingId, "file":fileName, "heatId":heatId, "raceId":None, "startTime":startTime.isoformat(), "seatCount":seatCount, "records":0, "duration":0.0}
+        self.seatCount = seatCount
+        self.startTime = now
+        self.blankRecord = bytes(FSR_RECORD_HEADER.size+seatCount*FSR_SEAT.size)
+        self.stopping = False
+        self.writer = gevent.spawn(self.writeLoop, self.file, self.recording)
+        logging.info("recording heat "+str(heatId)+" to "+fileName)
+
+    def record(self, now, store, sequence):
+        if(self.recording==None or self.stopping or store.size!=self.seatCount):
+            return
+        buffer = self.buffer
+        offset = len(buffer)
+        buffer.extend(self.blankRecord)
+        presence = 0
+        for seat in range(0, store.size):
+            if(store.present[seat]):
+                presence |= 1<<seat
+        FSR_RECORD_HEADER.pack_into(buffer, offset, now-self.startTime, sequence, presence)
+        offset += FSR_RECORD_HEADER.size
+        position = store.position
+        orientation = store.orientation
+        for seat in range(0, store.size):
+            index = seat*3
+            FSR_SEAT.pack_into(buffer, offset, position[index], position[index+1], position[index+2],
+                orientation[index], orientation[index+1], orientation[index+2], max(0, min(65535, store.rssi[seat])))
+            offset += FSR_SEAT.size
+        self.recording["records"] += 1
+        self.recording["duration"] = now-self.startTime
+
+    def stop(self):
+        #the writer flushes what is left, closes the file and adds it to the index
+        if(self.recording==None or self.stopping):
+            return
+        self.stopping = True
+        self.lastRecording = self.recording
+        self.wakeup.set()
+
+    def writeLoop(self, recordingFile, recording):
+        threadpool = gevent.get_hub().threadpool
+        while True:
+            self.wakeup.wait(RECORDING_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            stopping = self.stopping
+            if(len(self.buffer)>0):
+                data = self.buffer
+                self.buffer = bytearray()
+                threadpool.apply(recordingFile.write, (data,))
+            if(stopping):
+                break
+        threadpool.apply(recordingFile.close)
+        self.index.add(recording)
+        if(self.recording is recording):
+            self.recording = None
+            self.file = None
+            self.stopping = False
+        logging.info("saved recording "+recording["file"]+", "+str(recording["records"])+" records")
+
+    def tagRace(self, raceId):
+        #link the last finished recording to the race RotorHazard saved for it
+        if(self.lastRecording!=None and self.lastRecording["raceId"]==None):
+            self.lastRecording["raceId"] = raceId
+            self.index.save()
+
+class FSReplayServer():
+    #plays a recording back at its recorded cadence, reading records straight from a memory map
+    def __init__(self, send, finished):
+        self.send = send
+        self.finished = finished
+        self.active = False
+        self.greenlet = None
+        self.file = None
+        self.map = None
+        self.store = None
+        self.recordSize = 0
+        self.recordCount = 0
+        self.position = 0
+        self.speed = 1.0
+        self.resync = False
+
+    def open(self, path):
+        self.stop()
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, seatCount, reserved, startTime = FSR_HEADER.unpack_from(self.map, 0)
+        if(magic!=FSR_MAGIC or version!=FSR_VERSION):
+            self.close()
+            raise ValueError("unsupported recording "+path)
+        self.store = FSSeatStore(seatCount)
+        self.recordSize = FSR_RECORD_HEADER.size+seatCount*FSR_SEAT.size
+        self.recordCount = (len(self.map)-FSR_HEADER.size)//self.recordSize
+        self.position = 0
+
+    def recordTime(self, record):
+        return FSR_RECORD_HEADER.unpack_from(self.map, FSR_HEADER.size+record*self.recordSize)[0]
+
+    def seek(self, offset):
+        #binary search for the first record at or after offset seconds into the recording
+        low = 0
+        high = self.recordCount
+        while low<high:
+            middle = (low+high)//2
+            if(self.recordTime(middle)<offset):
+                low = middle+1
+            else:
+                high = middle
+        self.position = low
+        self.resync = True
+
+    def loadRecord(self, record):
+        store = self.store
+        offset = FSR_HEADER.size+record*self.recordSize
+        recordTime, sequence, presence = FSR_RECORD_HEADER.unpack_from(self.map, offset)
+        offset += FSR_RECORD_HEADER.size
+        for seat in range(0, store.size):
+            px, py, pz, ox, oy, oz, rssi = FSR_SEAT.unpack_from(self.map, offset)
+            offset += FSR_SEAT.size
+            index = seat*3
+            store.position[index] = px
+            store.position[index+1] = py
+            store.position[index+2] = pz
+            store.orientation[index] = ox
+            store.orientation[index+1] = oy
+            store.orientation[index+2] = oz
+            store.rssi[seat] = rssi
+            store.present[seat] = (presence>>seat)&1
+        return recordTime
+
+    def start(self, speed):
+        self.speed = max(0.1, speed)
+        self.resync = True
+        if(self.greenlet==None):
+            self.active = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        try:
+            while self.position<self.recordCount:
+                if(self.resync):
+                    self.resync = False
+                    startRecordTime = self.recordTime(self.position)
+                    startClock = monotonic()
+                recordTime = self.loadRecord(self.position)
+                wait = startClock+(recordTime-startRecordTime)/self.speed-monotonic()
+                if(wait>0):
+                    gevent.sleep(wait)
+                if(self.resync):
+                    continue
+                self.send(self.store, recordTime)
+                self.position += 1
+        finally:
+            self.finish()
+
+    def finish(self):
+        #runs once per playback, whether it played to the end or was stopped
+        if(not self.active):
+            return
+        self.active = False
+        self.greenlet = None
+        self.close()
+        self.finished()
+
+    def stop(self):
+        #a greenlet killed before it got to run never reaches its finally, so the playback is finished here too
+        if(self.greenlet!=None):
+            self.greenlet.kill()
+        self.finish()
+        self.close()
+
+    def close(self):
+        if(self.map!=None):
+            self.map.close()
+            self.map = None
+        if(self.file!=None):
+            self.file.close()
+            self.file = None
+
+class FSMetrics():
+    #counters and latency histograms for the socket handlers, packet traffic and seat update intervals
+    def __init__(self):
+        self.context = gevent.local.local()
+        self.handlers = {}
+        self.outbound = {}
+        self.seatIntervals = {}
+        self.lastRates = {"time":monotonic(), "packetsIn":0, "bytesIn":0, "packetsOut":0, "bytesOut":0}
+
+    def handlerStats(self, name):
+        stats = self.handlers.get(name)
+        if(stats==None):
+            stats = {"calls":0, "errors":0, "dbCalls":0, "sampledBytes":0, "samples":0, "latency":FSHistogram(), "inbound":False}
+            self.handlers[name] = stats
+        return stats
+
+    def wrap(self, name, handler, inbound=True):
+        #times the handler and attributes database calls made while it runs to it.
+        #only socket handlers are inbound traffic, background jobs are timed the same way but not counted as packets
+        stats = self.handlerStats(name)
+        stats["inbound"] = inbound
+        def instrumented(*args):
+            previous = getattr(self.context, "handler", None)
+            self.context.handler = name
+            stats["calls"] += 1
+            #payload sizes are sampled, serializing every packet again would cost more than the handler
+            if(len(args)>0 and stats["calls"]%TRAFFIC_SAMPLE_RATE==1):
+                stats["sampledBytes"] += payloadSize(args[0])
+                stats["samples"] += 1
+            start = monotonic()
+            try:
+                return handler(*args)
+            except Exception:
+                stats["errors"] += 1
+                raise
+            finally:
+                stats["latency"].record((monotonic()-start)*1000)
+                self.context.handler = previous
+        return instrumented
+
+    def countDbCall(self):
+        name = getattr(self.context, "handler", None)
+        if(name==None):
+            name = "background"
+        self.handlerStats(name)["dbCalls"] += 1
+
+    def recordOutbound(self, event, payload):
+        stats = self.outbound.get(event)
+        if(stats==None):
+            stats = {"packets":0, "bytes":0, "sampledBytes":0, "samples":0}
+            self.outbound[event] = stats
+        stats["packets"] += 1
+        if(isinstance(payload, bytes)):
+            stats["bytes"] += len(payload)
+        elif(stats["packets"]%TRAFFIC_SAMPLE_RATE==1):
+            stats["sampledBytes"] += payloadSize(payload)
+            stats["samples"] += 1
+
+    def recordSeatUpdate(self, seat, intervalMs):
+        histogram = self.seatIntervals.get(seat)
+        if(histogram==None):
+            histogram = FSHistogram()
+            self.seatIntervals[seat] = histogram
+        histogram.record(intervalMs)
+
+    def estimateBytes(self, stats, count):
+        if(stats["samples"]==0):
+            return 0
+        return int(stats["sampledBytes"]/stats["samples"]*count)
+
+    def report(self):
+        handlers = {}
+        packetsIn = 0
+        bytesIn = 0
+        for name, stats in self.handlers.items():
+            estimatedBytes = self.estimateBytes(stats, stats["calls"])
+            handlers[name] = {"calls":stats["calls"], "errors":stats["errors"], "dbCalls":stats["dbCalls"], "bytesIn":estimatedBytes, "latency":stats["latency"].toDict()}
+            if(stats["inbound"]):
+                packetsIn += stats["calls"]
+                bytesIn += estimatedBytes
+
+        outbound = {}
+        packetsOut = 0
+        bytesOut = 0
+        for event, stats in self.outbound.items():
+            eventBytes = stats["bytes"]+self.estimateBytes(stats, stats["packets"])
+            outbound[event] = {"packets":stats["packets"], "bytes":eventBytes}
+            packetsOut += stats["packets"]
+            bytesOut += eventBytes
+
+        #rates cover the time since the previous report
+        now = monotonic()
+        last = self.lastRates
+        elapsed = max(0.001, now-last["time"])
+        rates = {"packetsInPerSecond":(packetsIn-last["packetsIn"])/elapsed, "bytesInPerSecond":(bytesIn-last["bytesIn"])/elapsed,
+            "packetsOutPerSecond":(packetsOut-last["packetsOut"])/elapsed, "bytesOutPerSecond":(bytesOut-last["bytesOut"])/elapsed}
+        self.lastRates = {"time":now, "packetsIn":packetsIn, "bytesIn":bytesIn, "packetsOut":packetsOut, "bytesOut":bytesOut}
+
+        seats = {}
+        for seat, histogram in self.seatIntervals.items():
+            seats[seat] = histogram.toDict()
+        return {"handlers":handlers, "outbound":outbound, "rates":rates, "seatIntervals":seats}
+
+class FSSamplingProfiler():
+    #samples the stack of whatever greenlet is running from a real OS thread, so it also sees greenlets that never yield
+    def __init__(self):
+        self.running = False
+        self.samples = {}
+        self.sampleCount = 0
+        self.targetThread = None
+
+    def start(self):
+        if(self.running):
+            return
+        self.running = True
+        self.samples = {}
+        self.sampleCount = 0
+        self.targetThread = gevent.monkey.get_original("_thread", "get_ident")()
+        startThread = gevent.monkey.get_original("_thread", "start_new_thread")
+        startThread(self.run, ())
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        sleep = gevent.monkey.get_original("time", "sleep")
+        while self.running:
+            frame = sys._current_frames().get(self.targetThread)
+            stack = []
+            while frame!=None and len(stack)<PROFILER_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(os.path.basename(code.co_filename)+":"+code.co_name+":"+str(frame.f_lineno))
+                frame = frame.f_back
+            if(len(stack)>0):
+                key = " < ".join(stack)
+                self.samples[key] = self.samples.get(key, 0)+1
+                self.sampleCount += 1
+            sleep(PROFILER_INTERVAL)
+
+    def report(self, top=20):
+        samples = sorted(list(self.samples.items()), key=lambda sample: sample[1], reverse=True)[:top]
+        return {"running":self.running, "samples":self.sampleCount, "top":[{"stack":stack, "count":count} for stack, count in samples]}
+
+class FSCountingProxy():
+    #wraps an RHAPI section and counts the calls made through it
+    def __init__(self, target, count):
+        self._target = target
+        self._count = count
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if(not callable(attribute)):
+            return attribute
+        def counted(*args, **kwargs):
+            self._count()
+            return attribute(*args, **kwargs)
+        return counted
+
+class FSInstrumentedAPI():
+    #RHAPI stand-in the plugin works through, so database calls can be attributed to the handler making them
+    def __init__(self, rhapi, metrics):
+        self._rhapi = rhapi
+        self.db = FSCountingProxy(rhapi.db, metrics.countDbCall)
+
+    def __getattr__(self, name):
+        return getattr(self._rhapi, name)
+
+class FSOptionCache():
+    #typed copy of the plugin options so hot paths never have to touch the database
     def __init__(self, rhapi):
         self.rhapi = rhapi
+        self.values = {}
+
+    def load(self):
+        for option in DEFAULTS:
+            self.refresh(option)
+
+    def refresh(self, option):
+        value = self.rhapi.db.option(option)
+        if(value==None):
+            value = DEFAULTS[option]
+            self.rhapi.db.option_set(option, value)
+        self.values[option] = self.parse(option, value)
+
+    def parse(self, option, value):
+        optionType = OPTION_TYPES.get(option, str)
+        try:
+            if(optionType==bool):
+                return str(value) in ("1", "True", "true")
+            if(optionType==int):
+                return int(float(value))
+            return optionType(value)
+        except (TypeError, ValueError):
+            logging.info("invalid value "+str(value)+" for option "+option+", using default")
+            return self.parse(option, DEFAULTS[option])
+
+    def get(self, option):
+        if(option not in self.values):
+            self.refresh(option)
+        return self.values[option]
+
+class FSPilotIndex():
+    #SteamID <-> pilot id <-> callsign lookups so joins and state packets don't scan pilot attributes
+    def __init__(self, rhapi):
+        self.rhapi = rhapi
+        self.steamToPilots = {}
+        self.pilotToSteam = {}
+        self.callsigns = {}
+
+    def build(self):
+        self.steamToPilots = {}
+        self.pilotToSteam = {}
+        self.callsigns = {}
+        for pilot in self.rhapi.db.pilots:
+            steamId = self.rhapi.db.pilot_attribute_value(pilot.id, STEAM_ID, default_value=None)
+            self.set(pilot.id, steamId, pilot.callsign)
+        logging.info("indexed "+str(len(self.callsigns))+" pilots, "+str(len(self.steamToPilots))+" with steam IDs")
+
+    def refresh(self, pilotId):
+        pilot = self.rhapi.db.pilot_by_id(pilotId)
+        if(pilot==None):
+            self.remove(pilotId)
+        else:
+            steamId = self.rhapi.db.pilot_attribute_value(pilotId, STEAM_ID, default_value=None)
+            self.set(pilotId, steamId, pilot.callsign)
+
+    def set(self, pilotId, steamId, callsign):
+        self.remove(pilotId)
+        self.callsigns[pilotId] = callsign
+        if(steamId):
+            self.pilotToSteam[pilotId] = steamId
+            self.steamToPilots.setdefault(steamId, set()).add(pilotId)
+
+    def remove(self, pilotId):
+        self.callsigns.pop(pilotId, None)
+        steamId = self.pilotToSteam.pop(pilotId, None)
+        if(steamId!=None):
+            pilots = self.steamToPilots[steamId]
+            pilots.discard(pilotId)
+            if(len(pilots)==0):
+                del self.steamToPilots[steamId]
+
+    def pilotForSteamId(self, steamId):
+        #like pilot_ids_by_attribute, the oldest pilot wins if a steam ID was attached to several
+        pilots = self.steamToPilots.get(steamId)
+        if(pilots):
+            return min(pilots)
+        return None
+
+    def steamIdForPilot(self, pilotId):
+        return self.pilotToSteam.get(pilotId)
+
+    def callsignForPilot(self, pilotId):
+        return self.callsigns.get(pilotId)
+
+class FSClockEstimator():
+    #NTP style clock offset, round trip and jitter estimate for one seat from its recent ping exchanges
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_SAMPLE_WINDOW)
+        self.offset = 0.0
+        self.rtt = 0.0
+        self.maxRtt = 0.0
+        self.jitter = 0.0
+
+    def reset(self):
+        self.samples.clear()
+        self.offset = 0.0
+        self.rtt = 0.0
+        self.maxRtt = 0.0
+        self.jitter = 0.0
+
+    def addSample(self, serverSend, clientReceive, clientSend, serverReceive):
+        #offset is client clock minus server clock. time the client spent before answering isn't part of the round trip
+        rtt = (serverReceive-serverSend)-(clientSend-clientReceive)
+        if(rtt<0):
+            return False
+        offset = ((clientReceive-serverSend)+(clientSend-serverReceive))/2
+        self.samples.append((rtt, offset))
+
+        #like NTP's clock filter, the exchange with the shortest round trip gives the most accurate offset
+        best = min(self.samples)
+        self.rtt = best[0]
+        self.offset = best[1]
+        self.maxRtt = max([sample[0] for sample in self.samples])
+        self.jitter = (sum([(sample[1]-self.offset)**2 for sample in self.samples])/len(self.samples))**0.5
+        return True
+
+    def isSynced(self):
+        return len(self.samples)>=CLOCK_MIN_SAMPLES
+
+    def toServerTime(self, clientTime):
+        return clientTime-self.offset
+
+    def safeDelay(self):
+        #how long a lap has to be held so this seat's laps arrive before their deadline. the whole worst round trip is used since the path may be asymmetric
+        if(not self.isSynced()):
+            return None
+        return self.maxRtt+CLOCK_JITTER_FACTOR*self.jitter+CLOCK_SAFETY_MARGIN
+
+    def toDict(self):
+        safeDelay = self.safeDelay()
+        return {"samples":len(self.samples), "offsetMs":self.offset*1000, "rttMs":self.rtt*1000, "maxRttMs":self.maxRtt*1000, "jitterMs":self.jitter*1000,
+            "safeDelayMs":None if safeDelay==None else safeDelay*1000}
+
+class FSGateDetector():
+    #finds forward crossings of the start/finish gate from each seat's consecutive position samples.
+    #samples are buffered as they arrive and every seat's buffer is checked in one pass per server tick
+    def __init__(self, size):
+        self.gate = None
+        self.crossings = 0
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self.lastPosition = array("d", [0.0])*(3*size)
+        self.lastTime = array("d", [0.0])*size
+        self.lastDistance = array("d", [0.0])*size
+        self.lastCrossing = array("d", [-GATE_MIN_LAP_TIME])*size
+        self.hasSample = array("B", [0])*size
+        #per seat ring buffers of the samples received since the last check
+        self.sampleTimes = array("d", [0.0])*(GATE_SAMPLE_BUFFER*size)
+        self.samplePositions = array("d", [0.0])*(3*GATE_SAMPLE_BUFFER*size)
+        self.sampleCounts = array("H", [0])*size
+        self.sampleHeads = array("H", [0])*size
+
+    def setGate(self, gate):
+        self.gate = gate
+        for seat in range(0, self.size):
+            self.hasSample[seat] = 0
+            self.sampleCounts[seat] = 0
+
+    def reset(self, seat):
+        self.hasSample[seat] = 0
+        self.sampleCounts[seat] = 0
+        self.lastCrossing[seat] = -GATE_MIN_LAP_TIME
+
+    def record(self, seat, position, time):
+        if(self.gate==None):
+            return
+        slot = seat*GATE_SAMPLE_BUFFER+self.sampleHeads[seat]
+        self.sampleTimes[slot] = time
+        index = slot*3
+        self.samplePositions[index] = position[0]
+        self.samplePositions[index+1] = position[1]
+        self.samplePositions[index+2] = position[2]
+        self.sampleHeads[seat] = (self.sampleHeads[seat]+1)%GATE_SAMPLE_BUFFER
+        self.sampleCounts[seat] = min(GATE_SAMPLE_BUFFER, self.sampleCounts[seat]+1)
+
+    def detect(self, store):
+        #returns (seat, crossing time) for every pair of consecutive samples that went from behind the gate plane to past it
+        crossings = []
+        gate = self.gate
+        if(gate==None):
+            return crossings
+        cx, cy, cz = gate["center"]
+        nx, ny, nz = gate["normal"]
+        rx, ry, rz = gate["right"]
+        ux, uy, uz = gate["up"]
+        halfWidth = gate["halfWidth"]
+        halfHeight = gate["halfHeight"]
+        lastPosition = self.lastPosition
+        sampleTimes = self.sampleTimes
+        samplePositions = self.samplePositions
+
+        for seat in range(0, self.size):
+            if(not store.present[seat]):
+                self.hasSample[seat] = 0
+                self.sampleCounts[seat] = 0
+                continue
+            count = self.sampleCounts[seat]
+            if(count==0):
+                continue
+            self.sampleCounts[seat] = 0
+            index = seat*3
+            base = seat*GATE_SAMPLE_BUFFER
+            first = self.sampleHeads[seat]-count
+
+            #a fast client sends several samples per tick, a lap can start and end between any two of them
+            for sample in range(first, first+count):
+                slot = base+sample%GATE_SAMPLE_BUFFER
+                time = sampleTimes[slot]
+                x = samplePositions[slot*3]
+                y = samplePositions[slot*3+1]
+                z = samplePositions[slot*3+2]
+                distance = (x-cx)*nx+(y-cy)*ny+(z-cz)*nz
+
+                previous = self.lastDistance[seat]
+                if(self.hasSample[seat] and previous<0.0 and distance>=0.0):
+                    px = lastPosition[index]
+                    py = lastPosition[index+1]
+                    pz = lastPosition[index+2]
+                    dx = x-px
+                    dy = y-py
+                    dz = z-pz
+                    #respawns and resets jump across the map, they aren't laps
+                    if(dx*dx+dy*dy+dz*dz<=GATE_MAX_STEP*GATE_MAX_STEP):
+                        #where and when the segment between the two samples meets the plane
+                        fraction = previous/(previous-distance)
+                        qx = px+dx*fraction-cx
+                        qy = py+dy*fraction-cy
+                        qz = pz+dz*fraction-cz
+                        if(abs(qx*rx+qy*ry+qz*rz)<=halfWidth and abs(qx*ux+qy*uy+qz*uz)<=halfHeight):
+                            lastTime = self.lastTime[seat]
+                            crossingTime = lastTime+(time-lastTime)*fraction
+                            if(crossingTime-self.lastCrossing[seat]>=GATE_MIN_LAP_TIME):
+                                self.lastCrossing[seat] = crossingTime
+                                self.crossings += 1
+                                crossings.append((seat, crossingTime))
+
+                lastPosition[index] = x
+                lastPosition[index+1] = y
+                lastPosition[index+2] = z
+                self.lastTime[seat] = time
+                self.lastDistance[seat] = distance
+                self.hasSample[seat] = 1
+        return crossings
+
+class FSLapCrosscheck():
+    #pairs client reported laps with server detected crossings on the same seat and counts the ones only one side saw
+    def __init__(self):
+        self.clientLaps = {}
+        self.serverLaps = {}
+        self.matched = 0
+        self.clientOnly = 0
+        self.serverOnly = 0
+        self.difference = FSHistogram()
+
+    def match(self, pending, seat, time):
+        laps = pending.get(seat)
+        if(laps==None):
+            return False
+        for lap in laps:
+            if(abs(lap-time)<=GATE_CROSSCHECK_WINDOW):
+                laps.remove(lap)
+                self.matched += 1
+                self.difference.record(abs(lap-time)*1000)
+                return True
+        return False
+
+    def addClientLap(self, seat, time):
+        if(not self.match(self.serverLaps, seat, time)):
+            self.clientLaps.setdefault(seat, []).append(time)
+
+    def addServerLap(self, seat, time):
+        if(not self.match(self.clientLaps, seat, time)):
+            self.serverLaps.setdefault(seat, []).append(time)
+
+    def expire(self, now):
+        #a lap that found no partner within the window was only seen by one side
+        cutoff = now-2*GATE_CROSSCHECK_WINDOW
+        for pending, side in [(self.clientLaps, "client"), (self.serverLaps, "server")]:
+            for seat, laps in pending.items():
+                while len(laps)>0 and laps[0]<cutoff:
+                    laps.pop(0)
+                    logging.info("lap on node "+str(seat+1)+" was only counted by the "+side)
+                    if(side=="client"):
+                        self.clientOnly += 1
+                    else:
+                        self.serverOnly += 1
+
+    def reset(self, seat):
+        self.clientLaps.pop(seat, None)
+        self.serverLaps.pop(seat, None)
+
+    def getStats(self):
+        return {"matched":self.matched, "clientOnly":self.clientOnly, "serverOnly":self.serverOnly, "difference":self.difference.toDict()}
+
+class FSHistogram():
+    #fixed bucket histogram of millisecond latencies
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*(len(self.buckets)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, valueMs):
+        self.counts[bisect_left(self.buckets, valueMs)] += 1
+        self.count += 1
+        self.total += valueMs
+        self.max = max(self.max, valueMs)
+
+    def percentile(self, percent):
+        #upper bound of the bucket holding the given percentile, the max if it falls in the overflow bucket
+        if(self.count==0):
+            return 0.0
+        target = self.count*percent/100.0
+        seen = 0
+        for i in range(0, len(self.buckets)):
+            seen += self.counts[i]
+            if(seen>=target):
+                return float(self.buckets[i])
+        return self.max
+
+    def toDict(self):
+        mean = 0.0
+        if(self.count>0):
+            mean = self.total/self.count
+        return {"buckets":self.buckets, "counts":list(self.counts), "count":self.count, "meanMs":mean, "maxMs":self.max,
+            "p50Ms":self.percentile(50), "p99Ms":self.percentile(99)}
+
+class FSLapScheduler():
+    #one greenlet that sleeps until the next lap deadline and fires laps in deadline order
+    def __init__(self, fire):
+        self.fire = fire
+        self.queue = []
+        self.order = 0
+        self.wakeup = gevent.event.Event()
+        self.running = False
+        self.greenlet = None
+
+        #how late each lap fired relative to its deadline
+        self.lateness = FSHistogram()
+        self.seatLateness = {}
+
+    def start(self):
+        if(self.greenlet==None):
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def schedule(self, seat, deadline):
+        #order keeps laps with the same deadline in arrival order
+        self.order += 1
+        heapq.heappush(self.queue, (deadline, self.order, seat))
+        #wake the scheduler if this lap is now the next one due
+        if(self.queue[0][1]==self.order):
+            self.wakeup.set()
+
+    def run(self):
+        try:
+            while self.running:
+                if(len(self.queue)==0):
+                    self.wakeup.wait()
+                    self.wakeup.clear()
+                    continue
+
+                wait = self.queue[0][0]-monotonic()
+                if(wait>0):
+                    self.wakeup.wait(wait)
+                    self.wakeup.clear()
+                    continue
+
+                deadline, order, seat = heapq.heappop(self.queue)
+                #a lap that fails to count must not stop the laps queued behind it
+                try:
+                    self.fire(seat)
+                    self.recordLateness(seat, (monotonic()-deadline)*1000)
+                except Exception:
+                    logging.exception("failed to count a lap for node "+str(seat+1))
+        finally:
+            self.greenlet = None
+
+    def recordLateness(self, seat, lateMs):
+        self.lateness.record(lateMs)
+        stats = self.seatLateness.get(seat)
+        if(stats==None):
+            stats = {"laps":0, "lastMs":0.0, "maxMs":0.0, "totalMs":0.0}
+            self.seatLateness[seat] = stats
+        stats["laps"] += 1
+        stats["lastMs"] = lateMs
+        stats["maxMs"] = max(stats["maxMs"], lateMs)
+        stats["totalMs"] += lateMs
+
+    def getStats(self):
+        seats = {}
+        for seat, stats in self.seatLateness.items():
+            seats[seat] = {"laps":stats["laps"], "lastMs":stats["lastMs"], "maxMs":stats["maxMs"], "meanMs":stats["totalMs"]/stats["laps"]}
+        return {"pending":len(self.queue), "lateness":self.lateness.toDict(), "seats":seats}
+
+class FSLivenessTracker():
+    #tracks when each key was last heard from and reports connect/disconnect transitions.
+    #the expiry heap holds one entry per connected key, entries are pushed back when the key was refreshed in the meantime
+    def __init__(self, timeout, onConnect, onDisconnect):
+        self.timeout = timeout
+        self.onConnect = onConnect
+        self.onDisconnect = onDisconnect
+        self.lastSeen = {}
+        self.expiries = []
+
+    def touch(self, key, now):
+        connected = key in self.lastSeen
+        self.lastSeen[key] = now
+        if(not connected):
+            heapq.heappush(self.expiries, (now+self.timeout, key))
+            self.onConnect(key)
+
+    def expire(self, now):
+        while len(self.expiries)>0 and self.expiries[0][0]<=now:
+            expiry, key = heapq.heappop(self.expiries)
+            lastSeen = self.lastSeen.get(key)
+            if(lastSeen==None):
+                continue
+            if(lastSeen+self.timeout>now):
+                heapq.heappush(self.expiries, (lastSeen+self.timeout, key))
+            else:
+                del self.lastSeen[key]
+                self.onDisconnect(key)
+
+    def remove(self, key):
+        #stale heap entries for removed keys are skipped in expire
+        if(key in self.lastSeen):
+            del self.lastSeen[key]
+            self.onDisconnect(key)
+
+    def isConnected(self, key):
+        return key in self.lastSeen
+
+    def connectedKeys(self):
+        return list(self.lastSeen.keys())
+
+class FSBroadcastCoalescer():
+    #callers mark RotorHazard UI views dirty and one greenlet broadcasts each dirty view once per window
+    def __init__(self, rhapi, getWindow):
+        self.rhapi = rhapi
+        self.getWindow = getWindow
+        self.dirty = set()
+        self.wakeup = gevent.event.Event()
+        self.running = False
+        self.greenlet = None
+        self.counters = {}
+        for view in UI_VIEWS:
+            self.counters[view] = {"requested":0, "sent":0}
+
+    def start(self):
+        if(self.greenlet==None):
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def markDirty(self, *views):
+        for view in views:
+            self.counters[view]["requested"] += 1
+            self.dirty.add(view)
+
+        #without the flush greenlet there is nothing to wait for
+        if(self.running):
+            self.wakeup.set()
+        else:
+            self.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            #let the rest of the burst land before broadcasting
+            gevent.sleep(self.getWindow()/1000)
+            self.flush()
+        self.greenlet = None
+
+    def flush(self):
+        dirty = self.dirty
+        self.dirty = set()
+        for view in UI_VIEWS:
+            if(view in dirty):
+                getattr(self.rhapi.ui, "broadcast_"+view)()
+                self.counters[view]["sent"] += 1
+
+    def getStats(self):
+        stats = {}
+        for view, counters in self.counters.items():
+            stats[view] = {"requested":counters["requested"], "sent":counters["sent"], "suppressed":counters["requested"]-counters["sent"]-(view in self.dirty)}
+        return stats
+
+class FSDbWorker():
+    #database mutations run one at a time in submission order on their own greenlet, socket handlers and the tick loop never wait on a write
+    def __init__(self):
+        self.queue = deque()
+        self.wakeup = gevent.event.Event()
+        self.running = False
+        self.greenlet = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.maxDepth = 0
+        self.wait = FSHistogram()
+        self.duration = FSHistogram()
+
+    def start(self):
+        if(self.greenlet==None):
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        #jobs already queued are still written before the worker exits
+        self.running = False
+        self.wakeup.set()
+
+    def submit(self, name, job, callback=None):
+        #callback gets the job's result once it has been written
+        self.submitted += 1
+        #without the worker greenlet there is nothing to hand the job to
+        if(self.greenlet==None):
+            self.execute(name, job, callback, monotonic())
+            return
+        self.queue.append((name, job, callback, monotonic()))
+        self.maxDepth = max(self.maxDepth, len(self.queue))
+        self.wakeup.set()
+
+    def run(self):
+        while self.running or len(self.queue)>0:
+            if(len(self.queue)==0):
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            name, job, callback, submitTime = self.queue.popleft()
+            self.execute(name, job, callback, submitTime)
+            #let state packets and the tick loop in between jobs
+            gevent.sleep(0)
+        self.greenlet = None
+
+    def execute(self, name, job, callback, submitTime):
+        start = monotonic()
+        self.wait.record((start-submitTime)*1000)
+        try:
+            result = job()
+        except Exception:
+            self.failed += 1
+            logging.exception("database job "+name+" failed")
+            return
+        finally:
+            self.duration.record((monotonic()-start)*1000)
+        self.completed += 1
+        if(callback!=None):
+            try:
+                callback(result)
+            except Exception:
+                logging.exception("completion callback of database job "+name+" failed")
+
+    def getStats(self):
+        return {"depth":len(self.queue), "maxDepth":self.maxDepth, "submitted":self.submitted, "completed":self.completed, "failed":self.failed,
+            "wait":self.wait.toDict(), "duration":self.duration.toDict()}
+
+class FSManager():
+    def __init__(self, rhapi):
+        self.metrics = FSMetrics()
+        self.profiler = FSSamplingProfiler()
+        self.rhapi = FSInstrumentedAPI(rhapi, self.metrics)
+        self.options = FSOptionCache(self.rhapi)
+        self.pilotIndex = FSPilotIndex(self.rhapi)
+        self.lapScheduler = FSLapScheduler(self.addLap)
+        self.seatLiveness = FSLivenessTracker(UPDATE_TIMEOUT, self.handleSeatConnected, self.handleSeatDisconnected)
+        self.spectatorLiveness = FSLivenessTracker(UPDATE_TIMEOUT, self.handleSpectatorConnected, self.handleSpectatorDisconnected)
+        self.uiBroadcasts = FSBroadcastCoalescer(self.rhapi, lambda: self.getOption(UI_BROADCAST_WINDOW_INPUT))
+        self.dbWorker = FSDbWorker()
+        self.heatBuildPending = False
+        self.recorder = FSRaceRecorder(RECORDING_DIR)
+        self.replay = FSReplayServer(self.sendReplayFrame, self.handleReplayFinished)
+        self.replaySequence = REPLAY_SEQUENCE_BASE
         self.maxPlayerCount = MAX_PLAYERS
         self.maxSpectatorCount = MAX_SPECTATORS
         
         #websocket listeners
-        self.rhapi.ui.socket_listen("fs_set_state", self.setPlayerState)
-        self.rhapi.ui.socket_listen("fs_get_settings", self.setClientSettings)
-        self.rhapi.ui.socket_listen("fs_player_join", self.handlePlayerJoin)
-        self.rhapi.ui.socket_listen("fs_request_seat", self.handleSeatRequest)
-        self.rhapi.ui.socket_listen("fs_request_spectate", self.handleSpectateRequest)
-        self.rhapi.ui.socket_listen("fs_spectate", self.handleSpectate)
-        self.rhapi.ui.socket_listen("fs_add_lap", self.handleNewLap)
+        self.listen("fs_set_state", self.setPlayerState)
+        self.listen("fs_get_settings", self.setClientSettings)
+        self.listen("fs_player_join", self.handlePlayerJoin)
+        self.listen("fs_request_seat", self.handleSeatRequest)
+        self.listen("fs_request_spectate", self.handleSpectateRequest)
+        self.listen("fs_spectate", self.handleSpectate)
+        self.listen("fs_add_lap", self.handleNewLap)
+        self.listen("fs_ack", self.handleAck)
+        self.listen("fs_clock_pong", self.handleClockPong)
+        self.listen("fs_replay_list", self.handleReplayList)
+        self.listen("fs_replay_start", self.handleReplayStart)
+        self.listen("fs_replay_seek", self.handleReplaySeek)
+        self.listen("fs_replay_stop", self.handleReplayStop)
+        self.listen("fs_get_metrics", self.handleGetMetrics)
+        self.listen("fs_profiler", self.handleProfiler)
 
         #main game state that will be distributed to all players as well as updated by them
-        self.flowState = {"time":0.0,"states":[]}
+        self.seatStore = FSSeatStore(self.maxPlayerCount)
+        #what the last snapshot sent: every seat extrapolated to that tick's time, with its staleness
+        self.broadcastStore = FSSeatStore(self.maxPlayerCount)
+        self.motion = FSMotionHistory(self.maxPlayerCount)
+        self.extrapolatedSeats = 0
         self.flowStateMeta = []
-        self.spectatorMeta = []
+        self.spectatorMeta = {}
         self.cachedLaps = []
 
 
         for i in range(0, self.maxPlayerCount):
-            blankState = {"seat": -1, "position":[0,-100,0], "orientation":[0,0,0], "rssi":0}
-            self.flowState["states"].append(blankState)
-            blankMeta = {"lastUpdateTime":0.0, "steamId": ""}
+            blankMeta = {"steamId": ""}
             self.flowStateMeta.append(blankMeta)
             self.cachedLaps.append([])
 
-        for i in range(0, self.maxSpectatorCount):
-            blankMeta = {"lastUpdateTime":0.0, "steamId": ""}
-            self.spectatorMeta.append(blankMeta)
 
         self.lastTick = monotonic()
+
+        #server tick state. seat updates are merged into the seat store as they arrive and sent once per tick
+        self.stateDirty = False
+        self.tickRunning = False
+        self.tickGreenlet = None
+        self.tickMetrics = {"ticks":0, "sent":0, "overruns":0, "lastDurationMs":0.0, "maxDurationMs":0.0, "maxOverrunMs":0.0}
+
+        #the whole lobby shares one broadcast, so a single client without binary support keeps everyone on JSON
+        self.wireFormat = WIRE_FORMAT_JSON
+        self.legacyClientSeen = False
+
+        #recently sent snapshots, (sequence, seat store copy). deltas are taken against the oldest sequence every connected seat has acked
+        self.snapshotRing = deque(maxlen=SNAPSHOT_RING_SIZE)
+        self.snapshotSequence = 0
+        self.lastKeyframe = 0
+        self.forceKeyframe = True
+        self.seatAcks = [0]*self.maxPlayerCount
+
+        #per seat clock estimates used to pick the lap delay
+        self.seatClocks = [FSClockEstimator() for seat in range(0, self.maxPlayerCount)]
+        self.lastClockPing = 0.0
+
+        #server side lap detection from the position stream
+        self.gateDetector = FSGateDetector(self.maxPlayerCount)
+        self.lapCrosscheck = FSLapCrosscheck()
+
+        #pilots and spectators get their streams through separate socket.io rooms. the server is picked up from the first socket handler
+        self.socketio = None
+        self.streamRooms = {}
+        self.spectatorGreenlet = None
+        self.spectatorSequence = 0
+
+    def listen(self, event, handler):
+        #every socket handler is instrumented
+        self.rhapi.ui.socket_listen(event, self.metrics.wrap(event, handler))
+
+    def getMetrics(self):
+        return {"handlers":self.metrics.report(), "tick":self.tickMetrics, "laps":self.getLapLateness(), "clocks":self.getClockStats(), "gates":self.getGateStats(), "dbWorker":self.dbWorker.getStats(), "uiBroadcasts":self.getBroadcastStats(), "profiler":self.profiler.report()}
+
+    def handleGetMetrics(self, data=None):
+        self.sendToClient("fs_metrics", self.getMetrics(), None)
+
+    def handleProfiler(self, data):
+        #the sampling profiler can be switched on and off at runtime
+        if(data.get("enabled")):
+            logging.info("starting sampling profiler")
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+
+    def renderMetrics(self):
+        #read-only summary for the FlowState panel
+        report = self.metrics.report()
+        lines = ["#### Metrics", "", "| Handler | Calls | Errors | p50 ms | p99 ms | Max ms | DB Calls |", "|---|---|---|---|---|---|---|"]
+        for name, stats in sorted(report["handlers"].items()):
+            if(stats["calls"]==0 and stats["dbCalls"]==0):
+                continue
+            latency = stats["latency"]
+            lines.append("| "+name+" | "+str(stats["calls"])+" | "+str(stats["errors"])+" | "+str(latency["p50Ms"])+" | "+str(latency["p99Ms"])+" | "+str(round(latency["maxMs"], 2))+" | "+str(stats["dbCalls"])+" |")
+        rates = report["rates"]
+        lines.append("")
+        lines.append("In: "+str(round(rates["packetsInPerSecond"], 1))+" packets/s, "+str(int(rates["bytesInPerSecond"]))+" B/s. Out: "+str(round(rates["packetsOutPerSecond"], 1))+" packets/s, "+str(int(rates["bytesOutPerSecond"]))+" B/s")
+        lines.append("")
+        lines.append("Server ticks: "+str(self.tickMetrics["ticks"])+", overruns: "+str(self.tickMetrics["overruns"])+", max tick: "+str(round(self.tickMetrics["maxDurationMs"], 2))+" ms")
+        lateness = self.getLapLateness()["lateness"]
+        lines.append("")
+        dbWorker = self.dbWorker.getStats()
+        lines.append("Database queue: "+str(dbWorker["depth"])+" waiting, max "+str(dbWorker["maxDepth"])+", "+str(dbWorker["failed"])+" failed, wait p99 "+str(dbWorker["wait"]["p99Ms"])+" ms")
+        lines.append("")
+        lines.append("Lap delay: "+str(round(self.getLapDelay()*1000))+" ms")
+        lines.append("")
+        lines.append("Lap lateness: "+str(lateness["count"])+" laps, p50 "+str(lateness["p50Ms"])+" ms, p99 "+str(lateness["p99Ms"])+" ms, max "+str(round(lateness["maxMs"], 2))+" ms")
+        return "\n".join(lines)
+
+    def refreshMetricsPanel(self, args):
+        self.rhapi.ui.register_markdown(PANEL_NAME, METRICS_PANEL_NAME, self.renderMetrics())
+        self.rhapi.ui.broadcast_ui("run")
+
+    def startup(self, args):
+        self.options.load()
+        self.pilotIndex.build()
+        self.resizeLobby()
+        self.loadGate()
+        self.lapScheduler.start()
+        self.uiBroadcasts.start()
+        self.dbWorker.start()
+
+        #start the server tick loops
+        self.tickRunning = True
+        if(self.tickGreenlet==None):
+            self.tickGreenlet = gevent.spawn(self.tickLoop)
+        if(self.spectatorGreenlet==None):
+            self.spectatorGreenlet = gevent.spawn(self.spectatorLoop)
+
+    def shutdown(self, args):
+        self.tickRunning = False
+        self.recorder.stop()
+        self.replay.stop()
+        self.lapScheduler.stop()
+        self.uiBroadcasts.stop()
+        self.dbWorker.stop()
+
+    def tickLoop(self):
+        nextTick = monotonic()
+        try:
+            while self.tickRunning:
+                tickInterval = 1.0/max(1, self.getOption(SERVER_TICK_RATE_INPUT))
+                tickStart = monotonic()
+                #one failing tick must not stop the stream for the whole lobby
+                try:
+                    self.seatLiveness.expire(tickStart)
+                    self.serverTick(tickStart)
+                    self.clockTick(tickStart)
+                    self.gateTick(tickStart)
+                    self.recorder.record(tickStart, self.seatStore, self.snapshotSequence)
+                except Exception:
+                    logging.exception("server tick failed")
+                tickEnd = monotonic()
+                self.recordTick(tickEnd-tickStart, tickEnd-nextTick, tickInterval)
+
+                nextTick += tickInterval
+                #if we fell more than a whole tick behind, resync instead of bursting to catch up
+                if(tickEnd-nextTick>tickInterval):
+                    nextTick = tickEnd
+                gevent.sleep(max(0.0, nextTick-tickEnd))
+        finally:
+            self.tickGreenlet = None
+
+    def serverTick(self, now):
+        #only send a snapshot if a seat was updated since the last tick or is still being extrapolated. replays own the stream while they run
+        if((not self.stateDirty and self.extrapolatedSeats==0) or self.replay.active):
+            return
+        self.stateDirty = False
+
+        #every seat is sent as of this tick instead of as of its last packet
+        store = self.broadcastStore
+        self.extrapolatedSeats = self.motion.apply(self.seatStore, store, now, self.getOption(EXTRAPOLATION_INPUT)/1000)
+        sequence = self.snapshotSequence+1
+        baseline = self.findBaseline()
+        keyframe = self.forceKeyframe or baseline==None or sequence-self.lastKeyframe>=self.getOption(KEYFRAME_INTERVAL_INPUT)
+
+        changed = None
+        if(not keyframe):
+            changed = 0
+            for seat in range(0, store.size):
+                if(seatChanged(store, baseline[1], seat)):
+                    changed |= 1<<seat
+            #nothing moved far enough to be worth sending
+            if(changed==0):
+                return
+
+        self.snapshotSequence = sequence
+        #the ring has to hold what clients end up with, so seats left out of a delta keep their baseline values.
+        #otherwise a seat creeping under the thresholds would be measured against values nobody received
+        entry = store.copy()
+        if(not keyframe):
+            for seat in range(0, store.size):
+                if(not changed & (1<<seat)):
+                    entry.copySeat(baseline[1], seat)
+        self.snapshotRing.append((sequence, entry))
+        if(keyframe):
+            self.forceKeyframe = False
+            self.lastKeyframe = sequence
+
+        self.tickMetrics["sent"] += 1
+        if(self.wireFormat==WIRE_FORMAT_BINARY):
+            if(keyframe):
+                payload = encodeSnapshot(now, store, sequence)
+            else:
+                payload = encodeSnapshot(now, store, sequence, baseline[0], changed)
+        else:
+            if(keyframe):
+                payload = {"time":now, "sequence":sequence, "keyframe":True, "states":store.jsonStateList()}
+            else:
+                delta = {}
+                for seat in range(0, store.size):
+                    if(changed & (1<<seat)):
+                        delta[str(seat)] = store.jsonState(seat)
+                payload = {"time":now, "sequence":sequence, "baseline":baseline[0], "keyframe":False, "delta":delta}
+        self.sendToRoom("fs", payload, PILOT_ROOM)
+
+    def spectatorLoop(self):
+        #spectators get keyframes at their own, lower rate and never take part in the pilots' delta baselines
+        try:
+            while self.tickRunning:
+                now = monotonic()
+                try:
+                    self.spectatorLiveness.expire(now)
+                    if(len(self.spectatorMeta)>0 and self.spectatorSequence!=self.snapshotSequence and not self.replay.active):
+                        self.spectatorSequence = self.snapshotSequence
+                        self.sendToRoom("fs", self.buildKeyframe(now), SPECTATOR_ROOM)
+                except Exception:
+                    logging.exception("spectator tick failed")
+                gevent.sleep(1.0/max(1, self.getOption(SPECTATOR_TICK_RATE_INPUT)))
+        finally:
+            self.spectatorGreenlet = None
+
+    def buildKeyframe(self, now):
+        #full snapshot in the lobby's wire format, from the state of the latest pilot snapshot so it lines up with the sequence
+        if(self.wireFormat==WIRE_FORMAT_BINARY):
+            return encodeSnapshot(now, self.broadcastStore, self.snapshotSequence)
+        return {"time":now, "sequence":self.snapshotSequence, "keyframe":True, "states":self.broadcastStore.jsonStateList()}
+
+    def currentSid(self):
+        #session id of the client behind the current socket handler
+        if(not has_request_context()):
+            return None
+        if(self.socketio==None):
+            self.socketio = current_app.extensions["socketio"]
+        return request.sid
+
+    def joinStreamRoom(self, room, sid=None):
+        #puts a client in a stream room, by default the one behind the current socket handler. returns its session id
+        if(sid==None):
+            sid = self.currentSid()
+            if(sid==None):
+                return None
+        if(self.streamRooms.get(sid)!=room):
+            if(sid in self.streamRooms):
+                self.socketio.server.leave_room(sid, self.streamRooms[sid], namespace="/")
+            self.socketio.server.enter_room(sid, room, namespace="/")
+            self.streamRooms[sid] = room
+            #a spectator that takes a seat stops counting against the spectator limit
+            if(room==PILOT_ROOM and sid in self.spectatorMeta):
+                self.spectatorMeta.pop(sid)
+                self.spectatorLiveness.remove(sid)
+        return sid
+
+    def sendToClient(self, event, payload, sid):
+        #replies from database jobs run outside the socket handler, so they are addressed to the session id captured with the request
+        self.metrics.recordOutbound(event, payload)
+        if(sid!=None and self.socketio!=None):
+            self.socketio.emit(event, payload, to=sid)
+        else:
+            self.rhapi.ui.socket_send(event, payload)
+
+    def queueDbWrite(self, name, job, callback=None):
+        self.dbWorker.submit(name, self.metrics.wrap("db_"+name, job, inbound=False), callback)
+
+    def sendToRoom(self, event, payload, room):
+        self.metrics.recordOutbound(event, payload)
+        #until a client has joined a room there is no socket.io server to target rooms with
+        if(self.socketio!=None):
+            self.socketio.emit(event, payload, to=room)
+        else:
+            self.rhapi.ui.socket_broadcast(event, payload)
+
+    def getLobbySize(self):
+        #the lobby can't be bigger than the nodes RotorHazard exposes or the binary presence mask
+        return max(1, min(self.getOption(LOBBY_SIZE_INPUT), len(self.rhapi.interface.seats), FS_MAX_WIRE_SEATS))
+
+    def resizeLobby(self):
+        size = self.getLobbySize()
+        if(size==self.maxPlayerCount):
+            return
+        logging.info("resizing lobby from "+str(self.maxPlayerCount)+" to "+str(size)+" seats")
+
+        #seats that no longer exist are disconnected
+        for seat in self.seatLiveness.connectedKeys():
+            if(seat>=size):
+                self.seatLiveness.remove(seat)
+
+        self.maxPlayerCount = size
+        self.seatStore = FSSeatStore(size)
+        self.broadcastStore = FSSeatStore(size)
+        self.motion = FSMotionHistory(size)
+        self.extrapolatedSeats = 0
+        self.flowStateMeta = self.flowStateMeta[:size]
+        self.cachedLaps = self.cachedLaps[:size]
+        for i in range(len(self.flowStateMeta), size):
+            self.flowStateMeta.append({"steamId": ""})
+            self.cachedLaps.append([])
+
+        #seat numbering changed, every client needs a fresh keyframe and a fresh clock estimate
+        self.seatAcks = [0]*size
+        self.seatClocks = [FSClockEstimator() for seat in range(0, size)]
+        self.gateDetector.resize(size)
+        self.snapshotRing.clear()
+        self.forceKeyframe = True
+        self.stateDirty = True
+
+    def findBaseline(self):
+        #the oldest snapshot acknowledged by every connected seat, or None if a keyframe is needed
+        baselineSequence = None
+        for seat in range(0, len(self.flowStateMeta)):
+            if(self.seatLiveness.isConnected(seat)):
+                ack = self.seatAcks[seat]
+                if(ack==0):
+                    return None
+                if(baselineSequence==None or ack<baselineSequence):
+                    baselineSequence = ack
+
+        if(baselineSequence==None or len(self.snapshotRing)==0):
+            return None
+        index = baselineSequence-self.snapshotRing[0][0]
+        if(index<0 or index>=len(self.snapshotRing)):
+            return None
+        return self.snapshotRing[index]
+
+    def handleAck(self, data):
+        #clients acknowledge the latest snapshot sequence they have applied
+        seat = data["seat"]
+        if(seat<0 or seat>=self.maxPlayerCount):
+            return
+        #acks for replay frames say nothing about the live snapshots a client holds
+        if(data["sequence"]>=REPLAY_SEQUENCE_BASE):
+            return
+        if(data["sequence"]>self.seatAcks[seat] and data["sequence"]<=self.snapshotSequence):
+            self.seatAcks[seat] = data["sequence"]
+
+    def clockTick(self, now):
+        #every pilot answers the same ping with its own seat and clock. ping faster while a connected seat is still getting its first estimate
+        connectedSeats = self.seatLiveness.connectedKeys()
+        if(len(connectedSeats)==0):
+            return
+        interval = CLOCK_PING_INTERVAL
+        for seat in connectedSeats:
+            if(seat<self.maxPlayerCount and not self.seatClocks[seat].isSynced()):
+                interval = CLOCK_SYNC_PING_INTERVAL
+                break
+        if(now-self.lastClockPing<interval):
+            return
+        self.lastClockPing = now
+        self.sendToRoom("fs_clock_ping", {"serverTime":now}, PILOT_ROOM)
+
+    def handleClockPong(self, data):
+        #clientReceive and clientSend use the same clock as the time of fs_add_lap
+        serverReceive = monotonic()
+        seat = data["seat"]
+        if(seat<0 or seat>=self.maxPlayerCount):
+            return
+        clientReceive = data["clientReceive"]
+        clientSend = data.get("clientSend", clientReceive)
+        self.seatClocks[seat].addSample(data["serverTime"], clientReceive, clientSend, serverReceive)
+
+    def getLapDelay(self):
+        #the smallest delay that is safe for every connected seat, a lap from the slowest seat must not arrive after a later lap from a faster one was counted.
+        #the lap delay option is the cap, and what is used while any connected seat has no clock estimate yet
+        cap = self.getOption(LAP_DELAY_TIME_INPUT)/1000
+        delay = 0.0
+        for seat in self.seatLiveness.connectedKeys():
+            if(seat>=self.maxPlayerCount):
+                continue
+            seatDelay = self.seatClocks[seat].safeDelay()
+            if(seatDelay==None):
+                return cap
+            delay = max(delay, seatDelay)
+        if(delay==0.0):
+            return cap
+        return min(cap, delay)
+
+    def loadGate(self):
+        #server side lap detection stays off for tracks without gate geometry
+        self.gateDetector.setGate(None)
+        if(self.getOption(GATE_MODE_INPUT)==GATE_MODE_OFF):
+            return
+        track = self.getOption(TRACK_INPUT)
+        gate = loadGates(GATES_FILE).get(track)
+        if(gate==None):
+            logging.info("no gate geometry for track "+str(track)+" in "+GATES_FILE+", server side lap detection is off")
+            return
+        logging.info("server side lap detection for "+str(track)+" in "+self.getOption(GATE_MODE_INPUT)+" mode")
+        self.gateDetector.setGate(gate)
+
+    def serverLapsActive(self):
+        return self.gateDetector.gate!=None and self.getOption(GATE_MODE_INPUT)==GATE_MODE_REPLACE
+
+    def gateTick(self, now):
+        if(self.gateDetector.gate==None):
+            return
+        replace = self.serverLapsActive()
+        for seat, time in self.gateDetector.detect(self.seatStore):
+            #positions are timed on arrival, a synced seat's samples left the client about half a round trip earlier
+            if(self.seatClocks[seat].isSynced()):
+                time -= self.seatClocks[seat].rtt/2
+            if(replace):
+                self.scheduleLap(seat, time, now)
+            else:
+                self.lapCrosscheck.addServerLap(seat, time)
+        self.lapCrosscheck.expire(now)
+
+    def getGateStats(self):
+        return {"mode":self.getOption(GATE_MODE_INPUT), "track":self.getOption(TRACK_INPUT), "gateLoaded":self.gateDetector.gate!=None,
+            "crossings":self.gateDetector.crossings, "crosscheck":self.lapCrosscheck.getStats()}
+
+    def getClockStats(self):
+        seats = {}
+        for seat in range(0, self.maxPlayerCount):
+            if(len(self.seatClocks[seat].samples)>0):
+                seats[seat] = self.seatClocks[seat].toDict()
+        return {"lapDelayMs":self.getLapDelay()*1000, "seats":seats}
+
+    def recordTick(self, duration, lateness, tickInterval):
+        #lateness is how far past its scheduled start the tick finished
+        metrics = self.tickMetrics
+        metrics["ticks"] += 1
+        metrics["lastDurationMs"] = duration*1000
+        metrics["maxDurationMs"] = max(metrics["maxDurationMs"], duration*1000)
+        if(lateness>tickInterval):
+            overrun = (lateness-tickInterval)*1000
+            metrics["overruns"] += 1
+            metrics["maxOverrunMs"] = max(metrics["maxOverrunMs"], overrun)
+
     def loadDefaults(self):
         #load default values
         #if(self.getOption(LAP_DELAY_TIME_INPUT)==None):
@@ -145,126 +2057,251 @@ class FSManager():
         pass
     
     def getOption(self, option):
-        if(self.rhapi.db.option(option)==None):
-            default = DEFAULTS[option]
-            self.setOption(option, default)
-        return self.rhapi.db.option(option)
+        return self.options.get(option)
 
     def setOption(self, option, value):
         self.rhapi.db.option_set(option, value)
+        self.options.refresh(option)
+
+    def getPilotIdBySteamId(self, steamId):
+        return self.pilotIndex.pilotForSteamId(steamId)
+
+    def getSteamIdByPilotId(self, pilotId):
+        return self.pilotIndex.steamIdForPilot(pilotId)
+
+    def getCallsign(self, pilotId):
+        return self.pilotIndex.callsignForPilot(pilotId)
+
+    def handlePilotChanged(self, args):
+        self.pilotIndex.refresh(args["pilot_id"])
+
+    def handlePilotDeleted(self, args):
+        self.pilotIndex.remove(args["pilot_id"])
+
+    def rebuildPilotIndex(self, args):
+        self.pilotIndex.build()
+
+    def handleOptionSet(self, args):
+        #keep the option cache in sync with changes made from the RotorHazard UI
+        option = args.get("option")
+        if(option in DEFAULTS):
+            self.options.refresh(option)
+            if(option==AUTO_RUN_INPUT):
+                self.handleAutoRun()
+            elif(option==TRACK_INPUT or option==GATE_MODE_INPUT):
+                self.loadGate()
+
+    def handleRaceStage(self, args):
+        self.replay.stop()
+
+    def handleRaceStart(self, args):
+        self.replay.stop()
+        self.recorder.start(self.rhapi.race.heat, self.maxPlayerCount, monotonic())
+
+    def handleRaceStop(self, args):
+        self.recorder.stop()
+        self.handleRaceStatusChanged(args)
+
+    def handleLapsSave(self, args):
+        self.recorder.tagRace(args.get("race_id"))
+
+    def handleReplayList(self, data=None):
+        self.sendToClient("fs_replay_list", {"recordings":self.recorder.loadIndex().recordings}, None)
+
+    def raceLive(self):
+        #racing, staging or counting down to a scheduled heat
+        race = self.rhapi.race
+        return race.status==1 or race.status==3 or race.scheduled!=None
+
+    def handleReplayStart(self, data):
+        #replay a recording by saved race id or recording id, optionally from an offset in seconds.
+        #replays take over the pilots' stream, so they can't run while a race is live
+        if(self.raceLive()):
+            logging.info("replay refused, a race is live")
+            return
+        recording = self.recorder.loadIndex().find(recordingId=data.get("recordingId"), raceId=data.get("raceId"))
+        if(recording==None):
+            logging.info("no recording found for "+str(data))
+            return
+        try:
+            self.replay.open(os.path.join(RECORDING_DIR, recording["file"]))
+        except (OSError, ValueError, struct.error) as error:
+            logging.info("could not open recording "+recording["file"]+": "+str(error))
+            return
+        logging.info("replaying "+recording["file"])
+        self.replay.seek(data.get("offset", 0.0))
+        self.replay.start(data.get("speed", 1.0))
+
+    def handleReplaySeek(self, data):
+        if(self.replay.active):
+            self.replay.seek(data["offset"])
+
+    def handleReplayStop(self, data=None):
+        self.replay.stop()
+
+    def handleReplayFinished(self):
+        #hand the stream back to the live state with a fresh keyframe
+        self.forceKeyframe = True
+        self.stateDirty = True
+
+    def sendReplayFrame(self, store, recordTime):
+        self.replaySequence += 1
+        if(self.wireFormat==WIRE_FORMAT_BINARY):
+            payload = encodeSnapshot(recordTime, store, self.replaySequence, flags=FS_FLAG_REPLAY)
+        else:
+            payload = {"time":recordTime, "sequence":self.replaySequence, "keyframe":True, "replay":True, "states":store.jsonStateList()}
+        self.sendToRoom("fs", payload, PILOT_ROOM)
+        self.sendToRoom("fs", payload, SPECTATOR_ROOM)
+
+    def handleRaceStatusChanged(self, args):
+        self.handleAutoRun()
+        self.handleEarlyFinish()
+
+    def handleSeatConnected(self, seat):
+        logging.info("seat "+str(seat+1)+" connected")
+        #a pilot showing up after a race may be what the next heat is waiting for
+        self.handleAutoRun()
+
+    def handleSeatDisconnected(self, seat):
+        logging.info("seat "+str(seat+1)+" timed out")
+        #a client that went quiet stops getting the pilot stream until it sends state again
+        sid = self.flowStateMeta[seat].pop("sid", None)
+        if(self.streamRooms.get(sid)==PILOT_ROOM):
+            del self.streamRooms[sid]
+            self.socketio.server.leave_room(sid, PILOT_ROOM, namespace="/")
+        self.seatStore.clear(seat)
+        self.motion.reset(seat)
+        self.seatAcks[seat] = 0
+        self.seatClocks[seat].reset()
+        self.gateDetector.reset(seat)
+        self.lapCrosscheck.reset(seat)
+        self.stateDirty = True
+        #the remaining pilots may all be finished now
+        self.handleEarlyFinish()
 
     def handleAutoRun(self):
-        if(self.rhapi.db.option(AUTO_RUN_INPUT)=="1"):
+        #an empty lobby gets no heat, handleSeatConnected builds one when the first pilot arrives
+        if(self.getOption(AUTO_RUN_INPUT) and len(self.seatLiveness.connectedKeys())>0):
             #if the race is in the stopped state
             if(self.rhapi.race.status==2):
-                #if a heat hasn't been scheduled yet
-                if(self.rhapi.race.scheduled==None):
-                    logging.info("building next heat")
-
-                    #get the current heat
-                    currentHeat = self.rhapi.db.heat_by_id(self.rhapi.race.heat)
-
-                    #save the race that was just completed
-                    self.rhapi.race.save()
-
-                    #create a new heat
-                    newHeat = self.rhapi.db.heat_add(name=None, raceclass=currentHeat.class_id, auto_frequency=False)
-
-                    #set the current heat to the new heat
-                    self.rhapi.race.heat = newHeat.id
-
-                    #update the user interface
-                    self.rhapi.ui.broadcast_raceclasses()
-                    self.rhapi.ui.broadcast_current_heat()
-      
-                    #iterate over our connected pilots
-                    logging.info(str(self.flowStateMeta))
-                    connectedSeats = self.getConnectedSeats()
-                    logging.info("connected seats: "+str(connectedSeats))
-                    for seat in range(0,len(self.flowStateMeta)):
-                        connected = connectedSeats[seat]
-
-                        #if this pilot appears to be connected to the server
-                        if(connected):
-                            #find pilot id via steam id
-                            meta = self.flowStateMeta[seat]
-                            steamID = meta["steamId"]
-
-                            #if they have a valid steam ID
-                            if(steamID!=""):
-                                #add the pilot to the new heat
-                                pilotsWithSteamID = self.rhapi.db.pilot_ids_by_attribute(STEAM_ID,steamID)
-
-                                #found a pilot with a steam ID
-                                if(len(pilotsWithSteamID)>0):
-                                    pilotID = pilotsWithSteamID[0]
-                                    logging.info("adding pilot "+str(pilotID))
-                                    self.addPilotToCurrentHeat(pilotID)
-
-                    #schedule the next heat
-                    self.rhapi.race.schedule(self.getOption(RACE_COOLDOWN_TIME_INPUT))
-
-            self.handleEarlyFinish()
+                #if a heat hasn't been scheduled yet or isn't already being built
+                if(self.rhapi.race.scheduled==None and not self.heatBuildPending):
+                    #whoever noticed the race ended doesn't wait for the heat to be built
+                    self.heatBuildPending = True
+                    self.queueDbWrite("build_heat", self.buildNextHeat)
+
+    def buildNextHeat(self):
+        self.heatBuildPending = False
+        #the race may have moved on while this job was queued
+        if(self.rhapi.race.status!=2 or self.rhapi.race.scheduled!=None):
+            return
+        logging.info("building next heat")
+
+        #get the current heat
+        currentHeat = self.rhapi.db.heat_by_id(self.rhapi.race.heat)
+
+        #save the race that was just completed
+        self.rhapi.race.save()
+
+        #create a new heat
+        newHeat = self.rhapi.db.heat_add(name=None, raceclass=currentHeat.class_id, auto_frequency=False)
+
+        #set the current heat to the new heat
+        self.rhapi.race.heat = newHeat.id
+
+        #iterate over our connected pilots
+        logging.info(str(self.flowStateMeta))
+        connectedSeats = self.getConnectedSeats()
+        logging.info("connected seats: "+str(connectedSeats))
+        pilotIDs = []
+        for seat in range(0,len(self.flowStateMeta)):
+            connected = connectedSeats[seat]
+
+            #if this pilot appears to be connected to the server
+            if(connected):
+                #find pilot id via steam id
+                meta = self.flowStateMeta[seat]
+                steamID = meta["steamId"]
+
+                #if they have a valid steam ID
+                if(steamID!=""):
+                    #add the pilot to the new heat
+                    pilotID = self.getPilotIdBySteamId(steamID)
+
+                    #found a pilot with a steam ID
+                    if(pilotID!=None):
+                        pilotIDs.append(pilotID)
+
+        #fill the new heat in one pass and update the user interface once
+        self.assignPilotsToCurrentHeat(pilotIDs)
+        self.broadcastHeatChange()
+
+        #schedule the next heat
+        self.rhapi.race.schedule(self.getOption(RACE_COOLDOWN_TIME_INPUT))
 
     def handleNewLap(self,data):
         seat = data["seat"]
+        if(seat<0 or seat>=self.maxPlayerCount):
+            return
         time = data["time"]
-        lapDelay = self.getOption(LAP_DELAY_TIME_INPUT)
-        logging.info("lap delay: "+str(lapDelay))
-        gevent.spawn(self.addLapInFuture, seat, time+(int(lapDelay)/1000))
+        now = monotonic()
+        #laps are reported in the client's clock, a synced seat can be converted to server time
+        if(self.seatClocks[seat].isSynced()):
+            time = min(now, self.seatClocks[seat].toServerTime(time))
+        if(self.gateDetector.gate!=None):
+            #with server side detection the client's lap is either ignored or only compared
+            if(self.serverLapsActive()):
+                return
+            self.lapCrosscheck.addClientLap(seat, time)
+        self.scheduleLap(seat, time, now)
+
+    def scheduleLap(self, seat, time, now):
+        deadline = time+self.getLapDelay()
+        if(now>deadline):
+            logging.info("WARNING! Player on node "+str(seat+1)+" logged a lap that arrived "+str(now-deadline)+"s late")
+            self.rhapi.ui.message_speak("Warning! Lag detected when counting lap for node "+str(seat+1)+". Please increase lap delay, or check if the server needs more resources.")
+        self.lapScheduler.schedule(seat, deadline)
+
+    def addLap(self, node):
+        self.rhapi.interface.simulate_lap({"node":node})
 
-    def addLapInFuture(self, node, time):
-        if(monotonic()>time):
-            message = "WARNING! Player on node "+str(node+1)+" logged a lap that arrived "+str(monotonic()-time)+"s late"
-            logging.info(message)
+    def getLapLateness(self):
+        #lateness histogram and per seat stats for laps fired by the lap scheduler
+        return self.lapScheduler.getStats()
 
-            self.rhapi.ui.message_speak("Warning! Lag detected when counting lap for node "+str(node+1)+". Please increase lap delay, or check if the server needs more resources.")
-        else:
-            logging.info("Logging a lap time for node "+str(node+1)+" in "+str(time-+monotonic())+"s")
-        while True:
-            if(monotonic()>=time):
-                self.addLap(node, time)
-                logging.info("time: "+str(time))
-                break
-                
-            gevent.sleep()
-
-    def addLap(self, node, time):
-        addTime = monotonic()
-        self.rhapi.interface.simulate_lap({"node":node})
-        logging.info("Lap was added "+str((addTime-time)*1000)+"ms late")
+    def getBroadcastStats(self):
+        #requested, sent and suppressed UI broadcasts per view
+        return self.uiBroadcasts.getStats()
 
     def handleSeatRequest(self, data):
-        if(self.getOption(HEAT_LOCK_INPUT)):    
+        if(not self.getOption(HEAT_LOCK_INPUT)):
             logging.info("pilot "+str(data['pilotId'])+" requested to be join the current heat")
-            self.addPilotToCurrentHeat(data['pilotId'])
+            pilotId = data['pilotId']
+            self.queueDbWrite("seat_request", lambda: self.addPilotToCurrentHeat(pilotId))
         else:
             logging.info("pilot "+str(data['pilotId'])+" requested to be join the current heat but was denied")
 
     def handleSpectateRequest(self, data):
-        if(self.getOption(HEAT_LOCK_INPUT)):
+        if(not self.getOption(HEAT_LOCK_INPUT)):
             logging.info(data)
             logging.info("pilot "+str(data['pilotId'])+" requested to be removed from the current heat")
-            self.removePilotFromCurrentHeat(data['pilotId'])
+            pilotId = data['pilotId']
+            self.queueDbWrite("spectate_request", lambda: self.removePilotFromCurrentHeat(pilotId))
         else:
             logging.info("pilot "+str(data['pilotId'])+" requested to be removed form the current heat but was denied")
 
     def getConnectedSeats(self):
         connectedSeats = []
         for i in range(0,len(self.flowStateMeta)):
-            sto = self.flowStateMeta[i]["lastUpdateTime"]
-            
-            if(monotonic()-sto<UPDATE_TIMEOUT):
-                connectedSeats.append(True)
-            else:
-                connectedSeats.append(False)
-                self.flowState['states'][i] = {"seat": -1, "position":[0,-100,0], "orientation":[0,0,0], "rssi":0}
+            connectedSeats.append(self.seatLiveness.isConnected(i))
         return connectedSeats
 
     def handleEarlyFinish(self):
+        if(not self.getOption(AUTO_RUN_INPUT)):
+            return
         seatsConnected = self.getConnectedSeats()
-        #if the race is currently running
-        if(self.rhapi.race.status==1):
+        #if the race is currently running with someone still flying
+        if(self.rhapi.race.status==1 and (True in seatsConnected)):
             seatsFinished = self.rhapi.race.seats_finished
 
             #check if all the connected pilots are done
@@ -281,172 +2318,199 @@ class FSManager():
                 #stop the race early
                 self.rhapi.race.stop()
 
-    def findOpenSeat(self):
-        logging.info("findOpenSeat")
-
-        currentHeatID = self.rhapi.race.heat
-        logging.info("- "+str(currentHeatID))
-        slots = self.rhapi.db.slots_by_heat(currentHeatID)
-        logging.info("slots: "+str(slots))
-        openSeat = -1
-        for slot in slots:
-            logging.info(slot.pilot_id)
-            if(slot.pilot_id==0):
-                logging.info("found open slot! "+str(slot.node_index))
-                openSeat = slot.node_index
-                break
-        
-        return openSeat
-
     def handlePlayerJoin(self, data):
         logging.info("handlePlayerJoin")
         logging.info("seats already connected...")
         logging.info(str(self.getConnectedSeats()))
-        logging.info("searching for pilot...")
-        foundPilotsWithSteamID = self.rhapi.db.pilot_ids_by_attribute(STEAM_ID,data["steamId"])
-        foundPilot = None
-        if(len(foundPilotsWithSteamID)>0):
-            logging.info("found matching pilot! "+str(foundPilotsWithSteamID))
-            for pilot in foundPilotsWithSteamID:
-                if(pilot!=None):
-                    foundPilot = self.rhapi.db.pilot_by_id(pilot)
-                    if(foundPilot!=None):
-                        foundPilot.callsign = data["steamName"]
-                        break
+        #the pilot and heat writes happen on the database worker, the reply goes to this client once they are done
+        sid = self.currentSid()
+        self.queueDbWrite("player_join", lambda: self.joinPilot(data), lambda joined: self.completePlayerJoin(data, joined, sid))
 
-        #this pilot doesn't exist in the system yet. Let's add them
-        if(foundPilot==None):
+    def joinPilot(self, data):
+        #returns the pilot id and the seat they got, -1 if there was no room
+        logging.info("searching for pilot...")
+        pilotId = self.getPilotIdBySteamId(data["steamId"])
+        if(pilotId!=None):
+            logging.info("found matching pilot! "+str(pilotId))
+            #keep the callsign in sync with the player's steam name
+            if(self.getCallsign(pilotId)!=data["steamName"]):
+                self.rhapi.db.pilot_alter(pilot_id=pilotId, callsign=data["steamName"])
+                self.pilotIndex.set(pilotId, data["steamId"], data["steamName"])
+        else:
+            #this pilot doesn't exist in the system yet. Let's add them
             foundPilot = self.rhapi.db.pilot_add(name=data["steamName"], callsign=data["steamName"], phonetic=None, team=None, color=None)
-            self.rhapi.db.pilot_alter(pilot_id=foundPilot.id, attributes={STEAM_ID:data["steamId"]})
+            pilotId = foundPilot.id
+            self.rhapi.db.pilot_alter(pilot_id=pilotId, attributes={STEAM_ID:data["steamId"]})
+            self.pilotIndex.set(pilotId, data["steamId"], data["steamName"])
 
             #update the user interface
-            self.rhapi.ui.broadcast_pilots()
+            self.uiBroadcasts.markDirty("pilots")
 
         #add the pilot to the current heat
-        seat = self.addPilotToCurrentHeat(foundPilot.id)
+        return pilotId, self.addPilotToCurrentHeat(pilotId)
+
+    def completePlayerJoin(self, data, joined, sid):
+        pilotId, seat = joined
+
+        #the new client has no baseline yet, send everyone a keyframe
+        self.forceKeyframe = True
+        if(seat!=-1):
+            self.seatAcks[seat] = 0
+            self.seatClocks[seat].reset()
 
         #add the player to the spectator or the seated list depending on if there was a seat available
         if(seat==-1):
-            self.spectatorMeta[seat]["steamId"] = data["steamId"]
+            self.subscribeSpectator(data["steamId"], sid)
         else:
             self.flowStateMeta[seat]["steamId"] = data["steamId"]
-        logging.info("pilot joined: "+str(foundPilot.callsign)+", "+str(foundPilot.id))
-        self.rhapi.ui.socket_send("fs_join_success", {"pilotId":foundPilot.id, "seat":seat})
+        logging.info("pilot joined: "+str(data["steamName"])+", "+str(pilotId))
+        self.sendToClient("fs_join_success", {"pilotId":pilotId, "seat":seat}, sid)
 
     def addPilotToCurrentHeat(self, pilotID):
-        logging.info("adding pilot to current heat: "+str(pilotID))
-        #set the player in their slot if they are already in the heat
+        return self.addPilotsToCurrentHeat([pilotID])[pilotID]
+
+    def addPilotsToCurrentHeat(self, pilotIDs):
+        #assign pilots to the current heat and update the user interface once for the whole batch
+        seats, changed = self.assignPilotsToCurrentHeat(pilotIDs)
+        if(changed):
+            self.broadcastHeatChange()
+        return seats
+
+    def assignPilotsToCurrentHeat(self, pilotIDs):
+        #returns the seat each pilot ended up on (-1 if there was no room) and whether any slot was changed
+        pilotIDs = list(dict.fromkeys(pilotIDs))
+        seats = dict.fromkeys(pilotIDs, -1)
+        changed = False
         currentHeatID = self.rhapi.race.heat
-        slots = self.rhapi.db.slots_by_heat(currentHeatID)
-        foundSeat = -1
-        logging.info("checking if race is stopped")
+
         #if we aren't racing
-        if(self.rhapi.race.status!=1):
-            logging.info("Looking for pilot "+str(pilotID)+" in current heat "+str(currentHeatID))
-            for slot in slots:
-                p = self.rhapi.db.pilot_by_id(slot.pilot_id)
-                if(p!=None):
-                    p = p.callsign
-                logging.info("pilot "+str(p)+" is on slot "+str(slot.node_index))
-                #if the new pilot is already set to a slot in the current heat
-                if(slot.pilot_id==pilotID):
-                    #player is in the heat twice!
-                    if(foundSeat!=-1):
-                        #remove the pilot from the slot
-                        logging.info("removing pilot "+str(pilotID)+ " duplicate in heat "+str(currentHeatID)+", seat "+str(slot.node_index))
-                        self.rhapi.db.slot_alter(slot.id, method=ProgramMethod.NONE, pilot=0, seed_heat_id=None, seed_raceclass_id=None, seed_rank=None)
-                    else:
-                        #mark this as the slot we will use
-                        foundSeat = slot.node_index
-                        logging.info("Pilot with ID "+str(pilotID)+ " is already in heat "+str(currentHeatID))
-
-            #the player isn't in any of the heat's slots. Add them to an open slot if available
-            if(foundSeat==-1):
-                logging.info("pilot was not found in current heat")
-                #find an open seat if available
-                foundSeat = self.findOpenSeat()
-                logging.info("found open slot "+str(foundSeat))
-
-            #if we found a seat for the pilot, add him to it
-            if(foundSeat!=-1):
-                logging.info("adding pilot to heat "+str(currentHeatID)+" on seat "+str(foundSeat+1))
-                #add the pilot to the current heat
-                slot = slots[foundSeat]
+        if(self.rhapi.race.status==1):
+            logging.info("pilots "+str(pilotIDs)+" could not be added to the heat because a race is occuring")
+            return seats, changed
+
+        logging.info("adding pilots "+str(pilotIDs)+" to current heat "+str(currentHeatID))
+        slots = self.rhapi.db.slots_by_heat(currentHeatID)
+        openSlots = []
+        for slot in slots:
+            pilotID = slot.pilot_id
+            #only the first lobby size nodes are seats
+            inLobby = slot.node_index<self.maxPlayerCount
+            if(pilotID in seats):
+                #player is in the heat twice, or on a node outside the lobby!
+                if(seats[pilotID]!=-1 or not inLobby):
+                    logging.info("removing pilot "+str(pilotID)+ " duplicate in heat "+str(currentHeatID)+", seat "+str(slot.node_index))
+                    self.rhapi.db.slot_alter(slot.id, method=ProgramMethod.NONE, pilot=0, seed_heat_id=None, seed_raceclass_id=None, seed_rank=None)
+                    if(inLobby):
+                        openSlots.append(slot)
+                    changed = True
+                else:
+                    #mark this as the slot we will use
+                    seats[pilotID] = slot.node_index
+            elif(pilotID==0 and inLobby):
+                openSlots.append(slot)
+        openSlots.sort(key=lambda slot: slot.node_index)
+
+        #players that aren't in any of the heat's slots go to open slots while they last
+        for pilotID in pilotIDs:
+            if(seats[pilotID]==-1 and len(openSlots)>0):
+                slot = openSlots.pop(0)
+                logging.info("adding pilot "+str(self.getCallsign(pilotID))+" to heat "+str(currentHeatID)+" on seat "+str(slot.node_index+1))
                 self.rhapi.db.slot_alter(slot.id, method=ProgramMethod.ASSIGN, pilot=pilotID, seed_heat_id=None, seed_raceclass_id=None, seed_rank=None)
+                seats[pilotID] = slot.node_index
+                changed = True
 
-            #update user interface
-            self.rhapi.ui.broadcast_race_status()
-            self.rhapi.ui.broadcast_current_heat()
-            self.rhapi.ui.broadcast_heats()
-            self.rhapi.ui.broadcast_raceclasses()
-        else:
-            logging.info("pilot "+str(pilotID)+" could not be added to the heat because a race is occuring")
+        return seats, changed
 
-        return foundSeat
+    def broadcastHeatChange(self):
+        #update user interface
+        self.uiBroadcasts.markDirty("race_status", "current_heat", "heats", "raceclasses")
     
     def removePilotFromCurrentHeat(self, pilotID):
         #set the player in their slot if they are already in the heat
         currentHeatID = self.rhapi.race.heat
         slots = self.rhapi.db.slots_by_heat(currentHeatID)
-        foundSeat = -1
         logging.info("checking if race is stopped")
         #if we aren't racing
         if(self.rhapi.race.status!=1):
             logging.info("Looking for pilot "+str(pilotID)+" in current heat "+str(currentHeatID))
+            changed = False
             for slot in slots:
                 #if the new pilot is set to a slot in the current heat
                 if(slot.pilot_id==pilotID):
                     #remove the pilot from the slot
-                    logging.info("removing pilot "+str(pilotID)+ " duplicate in heat "+str(currentHeatID)+", seat "+str(slot.node_index))
+                    logging.info("removing pilot "+str(pilotID)+ " from heat "+str(currentHeatID)+", seat "+str(slot.node_index))
                     self.rhapi.db.slot_alter(slot.id, method=ProgramMethod.NONE, pilot=0, seed_heat_id=None, seed_raceclass_id=None, seed_rank=None)
+                    changed = True
 
-            #update user interface
-            self.rhapi.ui.broadcast_race_status()
-            self.rhapi.ui.broadcast_current_heat()
-            self.rhapi.ui.broadcast_heats()
-            self.rhapi.ui.broadcast_raceclasses()
+            if(changed):
+                self.broadcastHeatChange()
         else:
             logging.info("pilot "+str(pilotID)+" could not be removed from the heat because a race is occuring")
 
-    def handleSpectate(self):
-        #echo the flow state
-        self.flowState["time"] = monotonic()
-        self.rhapi.ui.socket_send("fs", self.flowState)
-
-        #WE GOTTA FIGURE OUT WHAT WE WANNA DO WITH SPECTATORS
-
-        #let's keep track of when this player was last updated
-        #self.spectatorMeta[seat]["lastUpdateTime"] = self.flowState["time"]
-
-        #self.handleAutoRun()
+    def handleSpectate(self, data=None):
+        #fs_spectate subscribes a spectator and then works as its heartbeat, the state itself is pushed by the spectator loop
+        steamId = ""
+        if(isinstance(data, dict)):
+            steamId = data.get("steamId", "")
+        self.subscribeSpectator(steamId)
+
+    def subscribeSpectator(self, steamId, sid=None):
+        if(sid==None):
+            sid = self.currentSid()
+            if(sid==None):
+                return
+        #a spectator turned away over the limit must not end up in the room and get the stream anyway
+        if(sid not in self.spectatorMeta and len(self.spectatorMeta)>=self.maxSpectatorCount):
+            logging.info("spectator limit reached, "+str(steamId)+" can't watch")
+            return
+        self.joinStreamRoom(SPECTATOR_ROOM, sid)
+        if(sid not in self.spectatorMeta):
+            self.spectatorMeta[sid] = {"steamId": steamId}
+            #give the new spectator something to show right away
+            self.sendToClient("fs", self.buildKeyframe(monotonic()), sid)
+        self.spectatorLiveness.touch(sid, monotonic())
+
+    def handleSpectatorConnected(self, sid):
+        logging.info("spectator "+str(self.spectatorMeta[sid]["steamId"])+" is watching")
+
+    def handleSpectatorDisconnected(self, sid):
+        self.spectatorMeta.pop(sid, None)
+        #the client may have taken a seat since, its pilot room entry stays
+        if(self.streamRooms.get(sid)==SPECTATOR_ROOM):
+            del self.streamRooms[sid]
+            self.socketio.server.leave_room(sid, SPECTATOR_ROOM, namespace="/")
 
     def setPlayerState(self, data):
         stateArrivalTime = monotonic()
         
         #logging.info(str(data))
         seat = data["seat"]
-        rssi = data["rssi"]
-
-        #update state
-        self.flowState["states"][seat] = data
-
-        #echo the flow state
-        self.flowState["time"] = monotonic()
-        self.rhapi.ui.socket_send("fs", self.flowState)
-
-        self.setRSSI(seat, rssi)
+        if(seat<0 or seat>=self.maxPlayerCount):
+            return
+
+        #update state in place. it will be sent out on the next server tick
+        wasPresent = self.seatStore.present[seat]
+        lastUpdate = self.seatStore.updateTimes[seat]
+        if(not self.seatStore.update(seat, data, stateArrivalTime)):
+            logging.info("dropped a state packet with non-finite values for seat "+str(seat+1))
+            return
+        if(wasPresent):
+            self.metrics.recordSeatUpdate(seat, (stateArrivalTime-lastUpdate)*1000)
+        self.motion.record(seat, data["position"], data["orientation"], stateArrivalTime)
+        self.gateDetector.record(seat, data["position"], stateArrivalTime)
+        self.stateDirty = True
+
+        self.setRSSI(seat, data["rssi"])
 
         #let's keep track of when this player was last updated
-        self.flowStateMeta[seat]["lastUpdateTime"] = stateArrivalTime
-        try:
-            steamID = self.rhapi.db.pilot_attribute_value(data["pilotId"], STEAM_ID, default_value=None)
-            self.flowStateMeta[seat]["steamId"] = steamID
-        except:
-            logging.info("unknown pilot is attempting to update a player's steam ID")
-
-        #handle tasks that need to run every time we get a client update
-        self.handleAutoRun()
-        #logging.info(self.flowState["time"])
+        meta = self.flowStateMeta[seat]
+        steamID = self.getSteamIdByPilotId(data.get("pilotId"))
+        if(steamID!=None):
+            meta["steamId"] = steamID
+        sid = self.joinStreamRoom(PILOT_ROOM)
+        if(sid!=None):
+            meta["sid"] = sid
+        self.seatLiveness.touch(seat, stateArrivalTime)
         
         
     def setRSSI(self, seat, value):
@@ -454,12 +2518,38 @@ class FSManager():
         nodes = interface.seats
         nodes[seat].current_rssi = value
     
-    def setClientSettings(self):
+    def negotiateWireFormat(self, data):
+        #clients advertise the binary snapshot versions they can decode in fs_get_settings
+        if(isinstance(data, dict)):
+            if(FS_WIRE_VERSION not in data.get("wireVersions", [])):
+                if(not self.legacyClientSeen):
+                    logging.info("a client without binary snapshot v"+str(FS_WIRE_VERSION)+" support connected, using JSON state")
+                self.legacyClientSeen = True
+
+        wireFormat = WIRE_FORMAT_JSON
+        if(self.getOption(WIRE_FORMAT_INPUT)==WIRE_FORMAT_BINARY and not self.legacyClientSeen):
+            wireFormat = WIRE_FORMAT_BINARY
+
+        #clients switching decoders need a fresh baseline
+        if(wireFormat!=self.wireFormat):
+            self.wireFormat = wireFormat
+            self.forceKeyframe = True
+        return self.wireFormat
+
+    def setClientSettings(self, data=None):
         logging.info("setClientSettings")
+        wireFormat = self.negotiateWireFormat(data)
         #TO-DO get rid of async state
-        serverSettings = {"track":self.getOption(TRACK_INPUT), "serverTickRate": self.getOption(SERVER_TICK_RATE_INPUT), "clientTickRate": self.getOption(CLIENT_TICK_RATE_INPUT), "jitterDampening": (100.0-float(self.getOption(CLIENT_JITTER_COMP_INPUT)))/100.0, "asyncState": True}
+        serverSettings = {"track":self.getOption(TRACK_INPUT), "serverTickRate": self.getOption(SERVER_TICK_RATE_INPUT), "clientTickRate": self.getOption(CLIENT_TICK_RATE_INPUT), "jitterDampening": (100.0-self.getOption(CLIENT_JITTER_COMP_INPUT))/100.0, "asyncState": True, "wireFormat": wireFormat, "wireVersion": FS_WIRE_VERSION, "lobbySize": self.maxPlayerCount, "spectatorTickRate": self.getOption(SPECTATOR_TICK_RATE_INPUT), "spectatorBuffer": self.getOption(SPECTATOR_BUFFER_INPUT), "clockPingInterval": CLOCK_PING_INTERVAL, "serverLaps": self.serverLapsActive(), "extrapolationLimit": self.getOption(EXTRAPOLATION_INPUT)}
+        #settings go to every client, not just the stream rooms, so this stays a plain broadcast
+        self.metrics.recordOutbound("fs_server_settings", serverSettings)
         self.rhapi.ui.socket_broadcast("fs_server_settings", serverSettings)
 
     def apply(self, args):
         logging.info("apply")
+        self.options.load()
+        self.resizeLobby()
+        self.loadGate()
+        #give binary a fresh chance, legacy clients will downgrade again when they request settings
+        self.legacyClientSeen = False
         self.setClientSettings()
@@ -0,0 +1,611 @@
+#load generation benchmark for the FlowState plugin
+#runs the real FSManager handlers against an in-process stand-in for RotorHazard's rhapi and reports
+#throughput, handler latency percentiles, outbound traffic and lap lateness for a number of simulated clients
+#
+#usage: python benchmark.py --clients 8 16 32 --duration 10 --output results.json
+#       python benchmark.py --compare results.json
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from time import monotonic
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_MODULE = "flowstate_plugin"
+
+#modules RotorHazard provides to plugins
+RH_MODULES = ["RHUtils", "Config", "requests", "eventmanager", "RHUI", "Database"]
+
+DEFAULT_CLIENTS = [8, 16, 32]
+DEFAULT_DURATION = 10.0
+DEFAULT_LAP_INTERVAL = 2.0
+DEFAULT_CODEC_ITERATIONS = 2000
+JOIN_TIMEOUT = 5.0
+
+#metrics that are compared against a previous result file, and whether bigger is better
+COMPARED_METRICS = [
+    ("throughput.packetsPerSecond", True),
+    ("handlers.fs_set_state.p99Ms", False),
+    ("handlers.fs_add_lap.p99Ms", False),
+    ("outbound.bytesPerSecond", False),
+    ("laps.hold.p50Ms", False),
+    ("laps.lateness.p99Ms", False),
+    ("tick.maxDurationMs", False)
+]
+
+class BenchEvt():
+    def __getattr__(self, name):
+        return name
+
+class BenchUIField():
+    def __init__(self, name, label, field_type=None, value=None, options=None, **kwargs):
+        self.name = name
+        self.label = label
+        self.value = value
+        self.options = options
+
+class BenchUIFieldType():
+    TEXT = "text"
+    BASIC_INT = "basic_int"
+    NUMBER = "number"
+    CHECKBOX = "checkbox"
+    SELECT = "select"
+
+class BenchUIFieldSelectOption():
+    def __init__(self, value, label):
+        self.value = value
+        self.label = label
+
+class BenchProgramMethod():
+    NONE = 0
+    ASSIGN = 1
+
+def stubModule(name, **attributes):
+    module = type(sys)(name)
+    for key, value in attributes.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+
+def installStubs():
+    #RotorHazard's modules only exist inside the server, anything that can't be imported is replaced with a minimal stand-in
+    stubs = {
+        "eventmanager": {"Evt":BenchEvt()},
+        "RHUI": {"UIField":BenchUIField, "UIFieldType":BenchUIFieldType, "UIFieldSelectOption":BenchUIFieldSelectOption},
+        "Database": {"ProgramMethod":BenchProgramMethod}
+    }
+    for name in RH_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            stubModule(name, **stubs.get(name, {}))
+
+def loadPlugin():
+    installStubs()
+    spec = importlib.util.spec_from_file_location(PLUGIN_MODULE, os.path.join(PLUGIN_DIR, "__init__.py"), submodule_search_locations=[PLUGIN_DIR])
+    plugin = importlib.util.module_from_spec(spec)
+    sys.modules[PLUGIN_MODULE] = plugin
+    spec.loader.exec_module(plugin)
+    return plugin
+
+def percentiles(samples):
+    #exact percentiles in milliseconds from raw samples in seconds
+    if(len(samples)==0):
+        return {"count":0, "meanMs":0.0, "p50Ms":0.0, "p90Ms":0.0, "p99Ms":0.0, "maxMs":0.0}
+    ordered = sorted(samples)
+    def at(percentile):
+        return ordered[min(len(ordered)-1, int(len(ordered)*percentile/100))]*1000
+    return {"count":len(ordered), "meanMs":sum(ordered)/len(ordered)*1000, "p50Ms":at(50), "p90Ms":at(90), "p99Ms":at(99), "maxMs":ordered[-1]*1000}
+
+class BenchRecorder():
+    #call counts and time spent in each fake rhapi method
+    def __init__(self):
+        self.calls = {}
+
+    def record(self, name, duration):
+        stats = self.calls.get(name)
+        if(stats==None):
+            stats = {"calls":0, "totalMs":0.0}
+            self.calls[name] = stats
+        stats["calls"] += 1
+        stats["totalMs"] += duration*1000
+
+class BenchSection():
+    #wraps one fake rhapi section so every method call is counted and timed
+    def __init__(self, prefix, target, recorder):
+        self._prefix = prefix
+        self._target = target
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if(not callable(attribute)):
+            return attribute
+        def timed(*args, **kwargs):
+            start = monotonic()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._recorder.record(self._prefix+"."+name, monotonic()-start)
+        return timed
+
+    def __setattr__(self, name, value):
+        if(name.startswith("_")):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._target, name, value)
+
+class BenchRecord():
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class BenchDB():
+    def __init__(self, seats):
+        self.seatCount = seats
+        self.options = {}
+        self.pilotList = []
+        self.attributes = {}
+        self.heats = {}
+        self.nextSlotId = 1
+        self.heat_add(name=None, raceclass=0)
+
+    @property
+    def pilots(self):
+        return list(self.pilotList)
+
+    def option(self, name):
+        return self.options.get(name)
+
+    def option_set(self, name, value):
+        self.options[name] = str(value)
+
+    def pilot_add(self, name=None, callsign=None, **kwargs):
+        pilot = BenchRecord(id=len(self.pilotList)+1, name=name, callsign=callsign)
+        self.pilotList.append(pilot)
+        return pilot
+
+    def pilot_alter(self, pilot_id, callsign=None, attributes=None, **kwargs):
+        pilot = self.pilot_by_id(pilot_id)
+        if(callsign!=None):
+            pilot.callsign = callsign
+        for key, value in (attributes or {}).items():
+            self.attributes[(pilot_id, key)] = value
+        return pilot
+
+    def pilot_by_id(self, pilot_id):
+        if(pilot_id==None or pilot_id<1 or pilot_id>len(self.pilotList)):
+            return None
+        return self.pilotList[pilot_id-1]
+
+    def pilot_attribute_value(self, pilot_id, name, default_value=None):
+        return self.attributes.get((pilot_id, name), default_value)
+
+    def heat_add(self, name=None, raceclass=0, **kwargs):
+        heatId = len(self.heats)+1
+        slots = []
+        for node in range(0, self.seatCount):
+            slots.append(BenchRecord(id=self.nextSlotId, heat_id=heatId, node_index=node, pilot_id=0))
+            self.nextSlotId += 1
+        self.heats[heatId] = BenchRecord(id=heatId, class_id=raceclass, slots=slots)
+        return self.heats[heatId]
+
+    def heat_by_id(self, heat_id):
+        return self.heats.get(heat_id)
+
+    def slots_by_heat(self, heat_id):
+        return list(self.heats[heat_id].slots)
+
+    def slot_alter(self, slot_id, method=None, pilot=None, **kwargs):
+        for heat in self.heats.values():
+            for slot in heat.slots:
+                if(slot.id==slot_id):
+                    slot.pilot_id = pilot
+                    return slot
+
+class BenchUI():
+    def __init__(self, payloadSize):
+        self.payloadSize = payloadSize
+        self.listeners = {}
+        self.lastSent = {}
+        self.outbound = {}
+        self.broadcasts = {}
+
+    def recordOutbound(self, event, payload):
+        stats = self.outbound.get(event)
+        if(stats==None):
+            stats = {"packets":0, "bytes":0}
+            self.outbound[event] = stats
+        stats["packets"] += 1
+        stats["bytes"] += self.payloadSize(payload)
+
+    def socket_listen(self, event, handler):
+        self.listeners[event] = handler
+
+    def socket_send(self, event, payload):
+        self.lastSent[event] = payload
+        self.recordOutbound(event, payload)
+
+    def socket_broadcast(self, event, payload):
+        self.lastSent[event] = payload
+        self.recordOutbound(event, payload)
+
+    def broadcast_ui(self, page):
+        pass
+
+    def broadcast_pilots(self):
+        self.broadcasts["pilots"] = self.broadcasts.get("pilots", 0)+1
+
+    def broadcast_raceclasses(self):
+        self.broadcasts["raceclasses"] = self.broadcasts.get("raceclasses", 0)+1
+
+    def broadcast_heats(self):
+        self.broadcasts["heats"] = self.broadcasts.get("heats", 0)+1
+
+    def broadcast_current_heat(self):
+        self.broadcasts["current_heat"] = self.broadcasts.get("current_heat", 0)+1
+
+    def broadcast_race_status(self):
+        self.broadcasts["race_status"] = self.broadcasts.get("race_status", 0)+1
+
+    def message_speak(self, message):
+        pass
+
+    def register_panel(self, *args, **kwargs):
+        pass
+
+    def register_quickbutton(self, *args, **kwargs):
+        pass
+
+    def register_markdown(self, *args, **kwargs):
+        pass
+
+class BenchRace():
+    def __init__(self):
+        self.status = 0
+        self.heat = 1
+        self.scheduled = None
+        self.seats_finished = {}
+
+    def save(self):
+        pass
+
+    def schedule(self, seconds, minutes=0):
+        self.scheduled = seconds
+
+    def stop(self, doSave=False):
+        self.status = 2
+
+class BenchInterface():
+    def __init__(self, seats, onLap):
+        self.seats = [BenchRecord(index=seat, current_rssi=0) for seat in range(0, seats)]
+        self.onLap = onLap
+
+    def simulate_lap(self, data):
+        self.onLap(data["node"], monotonic())
+
+class BenchFields():
+    def register_option(self, *args, **kwargs):
+        pass
+
+    def register_pilot_attribute(self, *args, **kwargs):
+        pass
+
+class BenchEvents():
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, event, handler, **kwargs):
+        self.handlers.setdefault(event, []).append(handler)
+
+    def trigger(self, event, args=None):
+        for handler in self.handlers.get(event, []):
+            handler(args or {})
+
+class BenchRHAPI():
+    #stand-in for rhapi with call counting on db, ui, race and interface
+    def __init__(self, seats, payloadSize, onLap):
+        self.recorder = BenchRecorder()
+        self.benchDb = BenchDB(seats)
+        self.benchUi = BenchUI(payloadSize)
+        self.benchRace = BenchRace()
+        self.benchInterface = BenchInterface(seats, onLap)
+        self.db = BenchSection("db", self.benchDb, self.recorder)
+        self.ui = BenchSection("ui", self.benchUi, self.recorder)
+        self.race = BenchSection("race", self.benchRace, self.recorder)
+        self.interface = BenchSection("interface", self.benchInterface, self.recorder)
+        self.fields = BenchFields()
+        self.events = BenchEvents()
+
+class BenchRun():
+    #one load run: a fresh plugin instance, a fixed number of clients and a fixed duration
+    def __init__(self, plugin, clients, args, wireFormat):
+        self.plugin = plugin
+        self.clients = clients
+        self.args = args
+        self.wireFormat = wireFormat
+        self.latencies = {}
+        self.errors = {}
+        self.pendingLaps = {}
+        self.lapHolds = []
+        self.joinTimes = []
+        self.lapsSent = 0
+        self.rhapi = BenchRHAPI(clients, plugin.payloadSize, self.handleLap)
+
+        options = self.rhapi.benchDb.options
+        options[plugin.LOBBY_SIZE_INPUT] = str(clients)
+        options[plugin.WIRE_FORMAT_INPUT] = wireFormat
+        options[plugin.UI_BROADCAST_WINDOW_INPUT] = str(plugin.DEFAULT_UI_BROADCAST_WINDOW)
+        if(args.client_tick_rate!=None):
+            options[plugin.CLIENT_TICK_RATE_INPUT] = str(args.client_tick_rate)
+        if(args.lap_delay!=None):
+            options[plugin.LAP_DELAY_TIME_INPUT] = str(args.lap_delay)
+        if(args.server_tick_rate!=None):
+            options[plugin.SERVER_TICK_RATE_INPUT] = str(args.server_tick_rate)
+
+    def call(self, event, data):
+        handler = self.rhapi.benchUi.listeners[event]
+        start = monotonic()
+        try:
+            handler(data)
+        except Exception:
+            self.errors[event] = self.errors.get(event, 0)+1
+            logging.exception("handler "+event+" failed")
+        self.latencies.setdefault(event, []).append(monotonic()-start)
+
+    def handleLap(self, seat, firedAt):
+        #how long the plugin held a lap between the client sending it and RotorHazard counting it
+        sentTimes = self.pendingLaps.get(seat)
+        if(sentTimes and len(sentTimes)>0):
+            self.lapHolds.append(firedAt-sentTimes.pop(0))
+
+    def join(self):
+        #clients join one at a time like they would when a lobby fills up. the join is written in the background, so wait for the reply
+        seats = []
+        sent = self.rhapi.benchUi.lastSent
+        for client in range(0, self.clients):
+            self.call("fs_get_settings", {"wireVersions":[self.plugin.FS_WIRE_VERSION]})
+            sent.pop("fs_join_success", None)
+            start = monotonic()
+            self.call("fs_player_join", {"steamId":"bench"+str(client), "steamName":"Bench "+str(client)})
+            while "fs_join_success" not in sent:
+                if(monotonic()-start>JOIN_TIMEOUT):
+                    raise RuntimeError("client "+str(client)+" got no fs_join_success")
+                gevent.sleep(0.001)
+            self.joinTimes.append(monotonic()-start)
+            seats.append(sent["fs_join_success"])
+        return seats
+
+    def client(self, seat, pilotId, index, end):
+        tickRate = self.manager.getOption(self.plugin.CLIENT_TICK_RATE_INPUT)
+        period = 1.0/max(1, tickRate)
+        #spread clients over the tick so they don't all arrive at once
+        nextSend = monotonic()+period*index/self.clients
+        nextLap = nextSend+self.args.lap_interval*(index+1)/self.clients
+        lastPing = None
+        step = 0
+        while True:
+            gevent.sleep(max(0.0, nextSend-monotonic()))
+            now = monotonic()
+            if(now>=end):
+                break
+            step += 1
+            #answer the latest clock ping, the simulated clients share the server's clock
+            ping = self.rhapi.benchUi.lastSent.get("fs_clock_ping")
+            if(ping!=None and ping is not lastPing):
+                lastPing = ping
+                self.call("fs_clock_pong", {"seat":seat, "serverTime":ping["serverTime"], "clientReceive":now, "clientSend":monotonic()})
+            self.call("fs_set_state", {"seat":seat, "pilotId":pilotId, "rssi":step%100, "position":[index*2.0+step*0.1, 1.0, step*0.05], "orientation":[0.0, (step*3.0)%360, 0.0]})
+            if(now>=nextLap):
+                self.pendingLaps.setdefault(seat, []).append(now)
+                self.lapsSent += 1
+                self.call("fs_add_lap", {"seat":seat, "time":now})
+                nextLap += self.args.lap_interval
+            nextSend += period
+
+    def run(self):
+        plugin = self.plugin
+        plugin.initialize(self.rhapi)
+        self.rhapi.events.trigger(plugin.Evt.STARTUP)
+        self.manager = self.rhapi.events.handlers[plugin.Evt.STARTUP][0].__self__
+
+        seats = self.join()
+        joinLatencies = list(self.latencies.get("fs_player_join", []))
+        self.rhapi.benchUi.outbound = {}
+
+        start = monotonic()
+        end = start+self.args.duration
+        greenlets = []
+        for index, joined in enumerate(seats):
+            if(joined["seat"]!=-1):
+                greenlets.append(gevent.spawn(self.client, joined["seat"], joined["pilotId"], index, end))
+        gevent.joinall(greenlets)
+        elapsed = monotonic()-start
+
+        #let the last laps reach their deadline before reading the results
+        gevent.sleep(self.manager.getOption(self.plugin.LAP_DELAY_TIME_INPUT)/1000+0.1)
+        self.rhapi.events.trigger(plugin.Evt.SHUTDOWN)
+        gevent.sleep(0.1)
+        return self.report(seats, joinLatencies, elapsed)
+
+    def report(self, seats, joinLatencies, elapsed):
+        handlers = {}
+        for event, samples in self.latencies.items():
+            if(event=="fs_player_join"):
+                samples = joinLatencies
+            stats = percentiles(samples)
+            stats["errors"] = self.errors.get(event, 0)
+            handlers[event] = stats
+
+        packets = 0
+        for event in ["fs_set_state", "fs_add_lap", "fs_clock_pong"]:
+            packets += len(self.latencies.get(event, []))
+        outboundPackets = 0
+        outboundBytes = 0
+        for stats in self.rhapi.benchUi.outbound.values():
+            outboundPackets += stats["packets"]
+            outboundBytes += stats["bytes"]
+
+        holds = percentiles(self.lapHolds)
+        lapStats = self.manager.getLapLateness()
+        tick = dict(self.manager.tickMetrics)
+        return {
+            "clients":self.clients,
+            "seated":len([joined for joined in seats if joined["seat"]!=-1]),
+            "wireFormat":self.manager.wireFormat,
+            "clientTickRate":self.manager.getOption(self.plugin.CLIENT_TICK_RATE_INPUT),
+            "serverTickRate":self.manager.getOption(self.plugin.SERVER_TICK_RATE_INPUT),
+            "durationSeconds":elapsed,
+            "join":percentiles(self.joinTimes),
+            "throughput":{"packets":packets, "packetsPerSecond":packets/elapsed},
+            "handlers":handlers,
+            "outbound":{"packets":outboundPackets, "bytes":outboundBytes, "packetsPerSecond":outboundPackets/elapsed, "bytesPerSecond":outboundBytes/elapsed, "events":self.rhapi.benchUi.outbound},
+            "laps":{"sent":self.lapsSent, "fired":holds["count"], "hold":holds, "lateness":lapStats["lateness"], "lapDelayMs":self.manager.getLapDelay()*1000},
+            "tick":tick,
+            "uiBroadcasts":self.rhapi.benchUi.broadcasts,
+            "rhapiCalls":self.rhapi.recorder.calls
+        }
+
+def benchmarkCodec(plugin, seats, iterations):
+    #size and encode time of a full keyframe and a full delta in both wire formats
+    store = plugin.FSSeatStore(seats)
+    for seat in range(0, seats):
+        store.update(seat, {"position":[seat*1.5, 2.25, -seat*0.75], "orientation":[10.0, seat*11.0, -5.0], "rssi":seat*7, "pilotId":seat+1}, 0.0)
+    allSeats = (1<<seats)-1
+
+    def jsonKeyframe():
+        return json.dumps({"time":1.0, "sequence":2, "keyframe":True, "states":store.jsonStateList()})
+
+    def jsonDelta():
+        delta = {}
+        for seat in range(0, seats):
+            delta[str(seat)] = store.jsonState(seat)
+        return json.dumps({"time":1.0, "sequence":2, "baseline":1, "keyframe":False, "delta":delta})
+
+    def binaryKeyframe():
+        return plugin.encodeSnapshot(1.0, store, 2)
+
+    def binaryDelta():
+        return plugin.encodeSnapshot(1.0, store, 2, 1, allSeats)
+
+    results = {}
+    for name, encode in [("jsonKeyframe", jsonKeyframe), ("jsonDelta", jsonDelta), ("binaryKeyframe", binaryKeyframe), ("binaryDelta", binaryDelta)]:
+        payload = encode()
+        start = monotonic()
+        for i in range(0, iterations):
+            encode()
+        encodeTime = (monotonic()-start)/iterations
+        results[name] = {"bytes":len(payload), "encodeUs":encodeTime*1000000}
+
+    payload = binaryKeyframe()
+    start = monotonic()
+    for i in range(0, iterations):
+        plugin.decodeSnapshot(payload)
+    results["binaryKeyframe"]["decodeUs"] = (monotonic()-start)/iterations*1000000
+    payload = jsonKeyframe()
+    start = monotonic()
+    for i in range(0, iterations):
+        json.loads(payload)
+    results["jsonKeyframe"]["decodeUs"] = (monotonic()-start)/iterations*1000000
+    return results
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def lookup(run, path):
+    value = run
+    for key in path.split("."):
+        if(not isinstance(value, dict) or key not in value):
+            return None
+        value = value[key]
+    return value
+
+def compareResults(baseline, current):
+    #prints the change of the key metrics for every run that exists in both result files
+    baselineRuns = {}
+    for run in baseline["runs"]:
+        baselineRuns[(run["clients"], run["wireFormat"])] = run
+    print("")
+    print("compared with "+str(baseline.get("revision"))+" ("+str(baseline.get("timestamp"))+")")
+    for run in current["runs"]:
+        previous = baselineRuns.get((run["clients"], run["wireFormat"]))
+        if(previous==None):
+            continue
+        print(str(run["clients"])+" clients, "+run["wireFormat"]+":")
+        for path, higherIsBetter in COMPARED_METRICS:
+            old = lookup(previous, path)
+            new = lookup(run, path)
+            if(old==None or new==None):
+                continue
+            change = 0.0
+            if(old!=0):
+                change = (new-old)/old*100
+            better = (change>=0)==higherIsBetter or change==0
+            print("  "+path.ljust(32)+str(round(old, 3)).rjust(12)+" -> "+str(round(new, 3)).ljust(12)+("%+.1f%%" % change)+("" if better else "  (worse)"))
+
+def printRun(run):
+    setState = run["handlers"].get("fs_set_state", percentiles([]))
+    holds = run["laps"]["hold"]
+    print(str(run["clients"]).rjust(3)+" clients "+run["wireFormat"].ljust(6)
+        +" in "+str(round(run["throughput"]["packetsPerSecond"], 1)).rjust(8)+" pkt/s"
+        +"  fs_set_state p50/p99 "+("%.3f/%.3f" % (setState["p50Ms"], setState["p99Ms"]))+" ms"
+        +"  out "+str(int(run["outbound"]["bytesPerSecond"])).rjust(8)+" B/s"
+        +"  lap hold p50/p99 "+("%.1f/%.1f" % (holds["p50Ms"], holds["p99Ms"]))+" ms"
+        +"  max tick "+("%.2f" % run["tick"]["maxDurationMs"])+" ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the FlowState RotorHazard plugin")
+    parser.add_argument("--clients", type=int, nargs="+", default=DEFAULT_CLIENTS, help="simulated client counts to run")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds of traffic per run")
+    parser.add_argument("--client-tick-rate", type=int, default=None, help="state packets per second per client, defaults to the plugin default")
+    parser.add_argument("--server-tick-rate", type=int, default=None, help="server snapshots per second, defaults to the plugin default")
+    parser.add_argument("--lap-interval", type=float, default=DEFAULT_LAP_INTERVAL, help="seconds between laps per client")
+    parser.add_argument("--lap-delay", type=int, default=None, help="lap delay cap in ms, defaults to the plugin default")
+    parser.add_argument("--wire-formats", nargs="+", default=["json", "binary"], help="snapshot wire formats to run")
+    parser.add_argument("--codec-iterations", type=int, default=DEFAULT_CODEC_ITERATIONS, help="iterations for the codec comparison")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="previous result file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show plugin logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    plugin = loadPlugin()
+    #the plugin monkey patches on import, so gevent is only imported after it
+    global gevent
+    import gevent
+
+    results = {"revision":gitRevision(), "timestamp":datetime.now().isoformat(), "python":platform.python_version(), "arguments":vars(args), "runs":[], "codec":{}}
+    for clients in args.clients:
+        if(clients>plugin.FS_MAX_WIRE_SEATS):
+            print("skipping "+str(clients)+" clients, the plugin supports at most "+str(plugin.FS_MAX_WIRE_SEATS)+" seats")
+            continue
+        for wireFormat in args.wire_formats:
+            run = BenchRun(plugin, clients, args, wireFormat).run()
+            results["runs"].append(run)
+            printRun(run)
+        results["codec"][str(clients)] = benchmarkCodec(plugin, clients, args.codec_iterations)
+
+    print("")
+    print("codec, bytes and encode us per snapshot:")
+    for clients, codec in results["codec"].items():
+        print(clients.rjust(3)+" seats  "+"  ".join([name+" "+str(stats["bytes"])+" B "+("%.1f" % stats["encodeUs"])+" us" for name, stats in codec.items()]))
+
+    if(args.output!=None):
+        with open(args.output, "w") as resultFile:
+            json.dump(results, resultFile, indent=2)
+        print("")
+        print("results written to "+args.output)
+
+    if(args.compare!=None):
+        with open(args.compare) as baselineFile:
+            compareResults(json.load(baselineFile), results)
+
+if __name__ == "__main__":
+    main()
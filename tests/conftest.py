@@ -0,0 +1,44 @@
+#the plugin is loaded the same way the benchmark does it, with stand-ins for RotorHazard's modules.
+#pytest also imports the plugin package itself while setting up the tests, so the stand-ins go in first
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import BenchRHAPI, installStubs, loadPlugin
+
+installStubs()
+
+@pytest.fixture(scope="session")
+def plugin():
+    return loadPlugin()
+
+@pytest.fixture
+def makeStore(plugin):
+    def make(size, states):
+        #states maps seat to (position, orientation, rssi)
+        store = plugin.FSSeatStore(size)
+        for seat, (position, orientation, rssi) in states.items():
+            assert store.update(seat, {"position":position, "orientation":orientation, "rssi":rssi, "pilotId":seat+1}, 0.0)
+        return store
+    return make
+
+@pytest.fixture
+def makeManager(plugin):
+    def make(seats, options=None, ui=None):
+        #a plugin instance on the benchmark's rhapi with its options loaded. the tick loops aren't started, tests drive the ticks themselves
+        rhapi = BenchRHAPI(seats, plugin.payloadSize, lambda seat, firedAt: None)
+        rhapi.benchDb.options[plugin.LOBBY_SIZE_INPUT] = str(seats)
+        for name, value in (options or {}).items():
+            rhapi.benchDb.options[name] = str(value)
+        #ui overrides go in before initialize so the socket handlers are registered with them
+        for name, handler in (ui or {}).items():
+            setattr(rhapi.ui, name, handler)
+        plugin.initialize(rhapi)
+        manager = rhapi.events.handlers[plugin.Evt.STARTUP][0].__self__
+        manager.options.load()
+        manager.resizeLobby()
+        return manager
+    return make
@@ -0,0 +1,22 @@
+import gevent
+
+def waitForJobs(manager):
+    manager.dbWorker.start()
+    gevent.sleep(0.05)
+    manager.dbWorker.stop()
+
+def test_no_heat_is_built_for_an_empty_lobby(plugin, makeManager):
+    manager = makeManager(2, {plugin.AUTO_RUN_INPUT:1})
+    manager.rhapi.benchRace.status = 2
+    heats = len(manager.rhapi.benchDb.heats)
+    manager.rhapi.events.trigger(plugin.Evt.RACE_STOP)
+    waitForJobs(manager)
+    assert len(manager.rhapi.benchDb.heats) == heats
+    assert manager.rhapi.benchRace.scheduled == None
+
+def test_first_pilot_starts_the_heat_build(plugin, makeManager):
+    manager = makeManager(2, {plugin.AUTO_RUN_INPUT:1})
+    manager.rhapi.benchRace.status = 2
+    manager.setPlayerState({"seat":0, "pilotId":0, "rssi":0, "position":[0, 0, 0], "orientation":[0, 0, 0]})
+    waitForJobs(manager)
+    assert manager.rhapi.benchRace.scheduled != None
@@ -0,0 +1,88 @@
+import copy
+
+import pytest
+
+@pytest.fixture
+def manager(plugin, makeManager):
+    def make(wireFormat):
+        manager = makeManager(2, {plugin.WIRE_FORMAT_INPUT:wireFormat, plugin.EXTRAPOLATION_INPUT:0})
+        manager.negotiateWireFormat({"wireVersions":[plugin.FS_WIRE_VERSION]})
+        return manager
+    return make
+
+class SimulatedClient():
+    #applies snapshots the way a pilot client does: deltas go on top of the snapshot they name as baseline
+    def __init__(self, plugin, manager):
+        self.plugin = plugin
+        self.manager = manager
+        self.history = {}
+        self.states = None
+        self.sequence = 0
+
+    def receive(self, payload):
+        if(isinstance(payload, bytes)):
+            payload = self.plugin.decodeSnapshot(payload)
+        if(payload["keyframe"]):
+            states = {}
+            for seat, state in enumerate(payload["states"]):
+                states[seat] = copy.deepcopy(state)
+        else:
+            states = copy.deepcopy(self.history[payload["baseline"]])
+            for seat, state in payload["delta"].items():
+                states[int(seat)] = copy.deepcopy(state)
+        self.history[payload["sequence"]] = states
+        self.states = states
+        self.sequence = payload["sequence"]
+        for seat in range(0, len(states)):
+            self.manager.handleAck({"seat":seat, "sequence":self.sequence})
+
+    def assertMatches(self, store):
+        plugin = self.plugin
+        for seat in range(0, store.size):
+            state = self.states[seat]
+            index = seat*3
+            #a client may lag the server by up to the delta thresholds, never more
+            assert state["position"] == pytest.approx(list(store.position[index:index+3]), abs=plugin.DELTA_POSITION_THRESHOLD+1/plugin.FS_POSITION_SCALE)
+            for axis in range(0, 3):
+                error = abs(((state["orientation"][axis]-store.orientation[index+axis]+180.0)%360.0)-180.0)
+                assert error <= plugin.DELTA_ORIENTATION_THRESHOLD+1/plugin.FS_ORIENTATION_SCALE
+
+def runTicks(plugin, manager, ticks, move):
+    client = SimulatedClient(plugin, manager)
+    sent = manager.rhapi.benchUi.lastSent
+    now = 0.0
+    for tick in range(0, ticks):
+        now += 0.1
+        for seat in range(0, 2):
+            position, orientation = move(seat, tick)
+            manager.setPlayerState({"seat":seat, "pilotId":0, "rssi":50, "position":position, "orientation":orientation})
+        sent.pop("fs", None)
+        manager.serverTick(now)
+        if("fs" in sent):
+            client.receive(sent["fs"])
+        client.assertMatches(manager.broadcastStore)
+    return client
+
+@pytest.mark.parametrize("wireFormat", ["json", "binary"])
+def test_slow_seat_does_not_drift(plugin, manager, wireFormat):
+    #seat 1 moves 1 m per tick and keeps deltas coming, seat 0 creeps 9 mm per tick, just under the threshold
+    server = manager(wireFormat)
+    def move(seat, tick):
+        if(seat==0):
+            return [tick*0.009, 0.0, 0.0], [0.0, 0.0, 0.0]
+        return [tick*1.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+    client = runTicks(plugin, server, 25, move)
+    #without keyframes in between, the slow seat was only kept in sync by deltas
+    assert server.lastKeyframe == 1
+    assert client.states[0]["position"][0] > 0.1
+
+@pytest.mark.parametrize("wireFormat", ["json", "binary"])
+def test_slow_yaw_does_not_drift(plugin, manager, wireFormat):
+    server = manager(wireFormat)
+    def move(seat, tick):
+        if(seat==0):
+            return [0.0, 0.0, 0.0], [0.0, tick*0.4, 0.0]
+        return [tick*1.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+    client = runTicks(plugin, server, 25, move)
+    assert server.lastKeyframe == 1
+    assert client.states[0]["orientation"][1] > 5.0
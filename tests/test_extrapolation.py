@@ -0,0 +1,51 @@
+import pytest
+
+def recordLine(plugin, history, seat, start, velocity, yawRate, times):
+    for time in times:
+        elapsed = time-times[0]
+        position = [start[0]+velocity[0]*elapsed, start[1]+velocity[1]*elapsed, start[2]+velocity[2]*elapsed]
+        history.record(seat, position, [0.0, plugin.wrapAngle(170.0+yawRate*elapsed), 0.0], time)
+
+def test_seat_is_extrapolated_to_the_tick(plugin, makeStore):
+    history = plugin.FSMotionHistory(1)
+    times = [1.0, 1.05, 1.1]
+    recordLine(plugin, history, 0, [0, 0, 0], [10.0, 0, 0], 200.0, times)
+    source = makeStore(1, {0:([1.0, 0, 0], [0, plugin.wrapAngle(170.0+200.0*0.1), 0], 0)})
+    source.updateTimes[0] = 1.1
+    target = plugin.FSSeatStore(1)
+
+    assert history.apply(source, target, 1.15, 0.1) == 1
+    assert target.position[0] == pytest.approx(1.5)
+    #the yaw turns through 180 without spinning the other way
+    assert target.orientation[1] == pytest.approx(plugin.wrapAngle(170.0+200.0*0.15))
+    assert target.staleness[0] == pytest.approx(50.0)
+
+def test_extrapolation_stops_at_the_limit(plugin, makeStore):
+    history = plugin.FSMotionHistory(1)
+    recordLine(plugin, history, 0, [0, 0, 0], [10.0, 0, 0], 0.0, [1.0, 1.05, 1.1])
+    source = makeStore(1, {0:([1.0, 0, 0], [0, 170.0, 0], 0)})
+    source.updateTimes[0] = 1.1
+    target = plugin.FSSeatStore(1)
+
+    assert history.apply(source, target, 2.1, 0.1) == 0
+    assert target.position[0] == pytest.approx(2.0)
+    assert target.staleness[0] == pytest.approx(1000.0)
+
+def test_respawn_is_not_extrapolated(plugin, makeStore):
+    history = plugin.FSMotionHistory(1)
+    history.record(0, [0, 0, 0], [0, 0, 0], 1.0)
+    history.record(0, [500, 0, 0], [0, 0, 0], 1.05)
+    source = makeStore(1, {0:([500, 0, 0], [0, 0, 0], 0)})
+    source.updateTimes[0] = 1.05
+    target = plugin.FSSeatStore(1)
+
+    history.apply(source, target, 1.1, 0.1)
+    assert target.position[0] == 500
+
+def test_older_client_falls_back_to_json(plugin, makeManager):
+    manager = makeManager(1, {plugin.WIRE_FORMAT_INPUT:plugin.WIRE_FORMAT_BINARY})
+
+    assert manager.negotiateWireFormat({"wireVersions":[plugin.FS_WIRE_VERSION]}) == plugin.WIRE_FORMAT_BINARY
+    assert manager.negotiateWireFormat({"wireVersions":[2]}) == plugin.WIRE_FORMAT_JSON
+    #once an older client is around everyone stays on JSON
+    assert manager.negotiateWireFormat({"wireVersions":[plugin.FS_WIRE_VERSION]}) == plugin.WIRE_FORMAT_JSON
@@ -0,0 +1,38 @@
+import pytest
+
+def makeDetector(plugin, makeStore):
+    detector = plugin.FSGateDetector(1)
+    detector.setGate(plugin.parseGate({"center":[0, 0, 0], "normal":[1, 0, 0], "width":10, "height":10}))
+    store = makeStore(1, {0:([0, 0, 0], [0, 0, 0], 0)})
+    return detector, store
+
+def test_crossing_between_ticks_uses_every_sample(plugin, makeStore):
+    detector, store = makeDetector(plugin, makeStore)
+    detector.record(0, [-10, 0, 0], 0.0)
+    assert detector.detect(store) == []
+
+    #three samples arrive before the next tick, the gate is crossed between the first two
+    detector.record(0, [-1, 0, 0], 0.1)
+    detector.record(0, [1, 0, 0], 0.11)
+    detector.record(0, [2, 0, 0], 0.2)
+    crossings = detector.detect(store)
+    assert len(crossings) == 1
+    assert crossings[0][0] == 0
+    assert crossings[0][1] == pytest.approx(0.105)
+
+def test_crossing_and_return_within_a_tick(plugin, makeStore):
+    #the newest sample is back behind the gate, only the samples in between show the crossing
+    detector, store = makeDetector(plugin, makeStore)
+    detector.record(0, [-1, 0, 0], 0.0)
+    detector.detect(store)
+    detector.record(0, [1, 0, 0], 0.05)
+    detector.record(0, [-1, 0, 0], 0.1)
+    assert len(detector.detect(store)) == 1
+
+def test_samples_are_consumed_once(plugin, makeStore):
+    detector, store = makeDetector(plugin, makeStore)
+    detector.record(0, [-1, 0, 0], 0.0)
+    detector.record(0, [1, 0, 0], 0.1)
+    assert len(detector.detect(store)) == 1
+    assert detector.detect(store) == []
+    assert detector.crossings == 1
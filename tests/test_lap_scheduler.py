@@ -0,0 +1,28 @@
+import gevent
+
+def test_failing_lap_does_not_stop_the_scheduler(plugin):
+    fired = []
+    def fire(seat):
+        if(seat==0):
+            raise RuntimeError("simulate_lap failed")
+        fired.append(seat)
+
+    scheduler = plugin.FSLapScheduler(fire)
+    scheduler.start()
+    now = plugin.monotonic()
+    scheduler.schedule(0, now)
+    scheduler.schedule(1, now+0.01)
+    gevent.sleep(0.05)
+
+    assert fired == [1]
+    assert scheduler.greenlet != None
+    scheduler.stop()
+    gevent.sleep(0)
+    assert scheduler.greenlet == None
+
+def test_lap_for_unknown_seat_is_ignored(plugin, makeManager):
+    manager = makeManager(2)
+
+    for seat in (-1, 2):
+        manager.handleNewLap({"seat":seat, "time":plugin.monotonic()})
+    assert len(manager.lapScheduler.queue) == 0
@@ -0,0 +1,25 @@
+import gevent
+
+def test_worker_jobs_are_not_inbound_packets(plugin, makeManager):
+    manager = makeManager(2)
+    manager.dbWorker.start()
+    manager.queueDbWrite("test_job", lambda: None)
+    gevent.sleep(0.05)
+    manager.dbWorker.stop()
+    manager.rhapi.benchUi.listeners["fs_ack"]({"seat":0, "sequence":0})
+
+    report = manager.metrics.report()
+    assert report["handlers"]["db_test_job"]["calls"] == 1
+    assert report["handlers"]["fs_ack"]["calls"] == 1
+    #the rate baseline holds the inbound totals the report counted
+    assert manager.metrics.lastRates["packetsIn"] == 1
+
+def test_replies_are_counted_as_outbound(plugin, makeManager):
+    manager = makeManager(1)
+    listeners = manager.rhapi.benchUi.listeners
+    listeners["fs_get_settings"]({"wireVersions":[plugin.FS_WIRE_VERSION]})
+    listeners["fs_get_metrics"]({})
+    outbound = manager.metrics.report()["outbound"]
+    for event in ("fs_server_settings", "fs_metrics"):
+        assert outbound[event]["packets"] == 1
+        assert outbound[event]["bytes"] > 0
@@ -0,0 +1,77 @@
+import gevent
+import pytest
+
+def makeReplay(plugin):
+    finished = []
+    replay = plugin.FSReplayServer(lambda store, recordTime: None, lambda: finished.append(True))
+    return replay, finished
+
+def test_stop_before_playback_started(plugin):
+    replay, finished = makeReplay(plugin)
+    replay.start(1.0)
+    replay.stop()
+    assert finished == [True]
+    assert not replay.active
+    assert replay.greenlet == None
+
+    #the replay can be started again afterwards
+    replay.start(1.0)
+    assert replay.greenlet != None
+    replay.stop()
+    assert finished == [True, True]
+
+def test_playback_finishes_once(plugin):
+    replay, finished = makeReplay(plugin)
+    replay.start(1.0)
+    gevent.sleep(0.01)
+    assert finished == [True]
+    replay.stop()
+    assert finished == [True]
+
+@pytest.fixture
+def recorded(plugin, makeManager, makeStore, tmp_path, monkeypatch):
+    #a manager with one short race recorded and saved as race 7
+    monkeypatch.setattr(plugin, "RECORDING_DIR", str(tmp_path))
+    manager = makeManager(2)
+    manager.recorder = plugin.FSRaceRecorder(str(tmp_path))
+    store = makeStore(2, {0:([0, 0, 0], [0, 0, 0], 0)})
+    manager.recorder.start(1, 2, 0.0)
+    for record in range(0, 20):
+        manager.recorder.record(record*0.1, store, record+1)
+    manager.recorder.stop()
+    manager.recorder.writer.join()
+    manager.recorder.tagRace(7)
+    return manager
+
+@pytest.mark.parametrize("status, scheduled", [(1, None), (3, None), (2, 30)])
+def test_replay_refused_while_a_race_is_live(recorded, status, scheduled):
+    race = recorded.rhapi.benchRace
+    race.status = status
+    race.scheduled = scheduled
+    recorded.handleReplayStart({"raceId":7})
+    assert not recorded.replay.active
+
+def test_staging_a_race_ends_the_replay(plugin, recorded):
+    recorded.handleReplayStart({"raceId":7})
+    assert recorded.replay.active
+    recorded.rhapi.events.trigger(plugin.Evt.RACE_STAGE)
+    assert not recorded.replay.active
+
+    #the live stream picks up again with a keyframe
+    sent = recorded.rhapi.benchUi.lastSent
+    sent.pop("fs", None)
+    recorded.setPlayerState({"seat":0, "pilotId":0, "rssi":0, "position":[1, 0, 0], "orientation":[0, 0, 0]})
+    recorded.serverTick(plugin.monotonic())
+    assert sent["fs"]["keyframe"] and "replay" not in sent["fs"]
+
+def test_replay_acks_are_ignored(plugin, makeManager, makeStore):
+    manager = makeManager(1)
+    sent = manager.rhapi.benchUi.lastSent
+    manager.setPlayerState({"seat":0, "pilotId":0, "rssi":0, "position":[1, 0, 0], "orientation":[0, 0, 0]})
+    manager.serverTick(plugin.monotonic())
+    manager.handleAck({"seat":0, "sequence":sent["fs"]["sequence"]})
+
+    manager.sendReplayFrame(makeStore(1, {}), 0.0)
+    assert sent["fs"]["sequence"] >= plugin.REPLAY_SEQUENCE_BASE
+    manager.handleAck({"seat":0, "sequence":sent["fs"]["sequence"]})
+    assert manager.seatAcks[0] == manager.snapshotSequence
@@ -0,0 +1,65 @@
+import pytest
+
+flask = pytest.importorskip("flask")
+flask_socketio = pytest.importorskip("flask_socketio")
+
+@pytest.fixture
+def server(makeManager):
+    #a real socket.io server so room membership is what decides who gets the stream
+    app = flask.Flask("flowstate_test")
+    socketio = flask_socketio.SocketIO(app, async_mode="threading")
+    manager = makeManager(2, ui={"socket_listen": lambda event, handler: socketio.on_event(event, handler),
+        "socket_send": lambda event, payload: flask_socketio.emit(event, payload),
+        "socket_broadcast": lambda event, payload: socketio.emit(event, payload)})
+    return manager, socketio.test_client(app), socketio.test_client(app)
+
+def streamed(client):
+    return [message for message in client.get_received() if message["name"]=="fs"]
+
+def test_spectator_over_the_limit_gets_no_stream(plugin, server):
+    manager, first, second = server
+    manager.maxSpectatorCount = 1
+    first.emit("fs_spectate", {"steamId":"first"})
+    second.emit("fs_spectate", {"steamId":"second"})
+    assert len(manager.spectatorMeta) == 1
+    assert len(manager.streamRooms) == 1
+
+    first.get_received()
+    manager.sendToRoom("fs", {"sequence":1}, plugin.SPECTATOR_ROOM)
+    assert len(streamed(first)) == 1
+    assert len(streamed(second)) == 0
+
+def test_timed_out_pilot_leaves_the_pilot_room(plugin, server):
+    manager, pilot, spectator = server
+    state = {"seat":0, "pilotId":0, "rssi":0, "position":[0, 0, 0], "orientation":[0, 0, 0]}
+    pilot.emit("fs_set_state", state)
+    manager.seatLiveness.expire(plugin.monotonic()+plugin.UPDATE_TIMEOUT+1)
+    assert len(manager.streamRooms) == 0
+
+    pilot.get_received()
+    manager.sendToRoom("fs", {"sequence":1}, plugin.PILOT_ROOM)
+    assert len(streamed(pilot)) == 0
+
+    #sending state again puts the pilot back in the room
+    pilot.emit("fs_set_state", state)
+    manager.sendToRoom("fs", {"sequence":2}, plugin.PILOT_ROOM)
+    assert len(streamed(pilot)) == 1
+
+def test_spectator_taking_a_seat(plugin, server):
+    manager, client, spectator = server
+    manager.maxSpectatorCount = 1
+    client.emit("fs_spectate", {"steamId":"client"})
+    client.emit("fs_set_state", {"seat":0, "pilotId":0, "rssi":0, "position":[0, 0, 0], "orientation":[0, 0, 0]})
+    assert len(manager.spectatorMeta) == 0
+    assert list(manager.streamRooms.values()) == [plugin.PILOT_ROOM]
+
+    #the spectator heartbeat running out later leaves the seated client alone
+    manager.spectatorLiveness.expire(plugin.monotonic()+plugin.UPDATE_TIMEOUT+1)
+    assert list(manager.streamRooms.values()) == [plugin.PILOT_ROOM]
+    client.get_received()
+    manager.sendToRoom("fs", {"sequence":1}, plugin.PILOT_ROOM)
+    assert len(streamed(client)) == 1
+
+    #and the spectator slot is free again
+    spectator.emit("fs_spectate", {"steamId":"spectator"})
+    assert len(manager.spectatorMeta) == 1
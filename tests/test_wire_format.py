@@ -0,0 +1,95 @@
+import struct
+
+import pytest
+
+def assertSeat(plugin, decoded, position, orientation, rssi):
+    assert decoded["position"] == pytest.approx(position, abs=0.5/plugin.FS_POSITION_SCALE)
+    assert decoded["orientation"] == pytest.approx(orientation, abs=1/plugin.FS_ORIENTATION_SCALE)
+    assert decoded["rssi"] == rssi
+
+def test_keyframe_round_trip(plugin, makeStore):
+    states = {0:([1.5, 2.25, -3.125], [10.0, -45.5, 179.0], 42), 2:([-100.001, 0.0, 55.5], [0.0, 90.0, -90.0], 7)}
+    store = makeStore(4, states)
+    decoded = plugin.decodeSnapshot(plugin.encodeSnapshot(12.5, store, 7))
+
+    assert decoded["keyframe"]
+    assert decoded["sequence"] == 7
+    assert decoded["time"] == 12.5
+    assert "replay" not in decoded
+    assert len(decoded["states"]) == 4
+    for seat, (position, orientation, rssi) in states.items():
+        assert decoded["states"][seat]["seat"] == seat
+        assertSeat(plugin, decoded["states"][seat], position, orientation, rssi)
+    assert decoded["states"][1]["seat"] == -1
+    assert decoded["states"][3]["seat"] == -1
+
+def test_replay_flag(plugin, makeStore):
+    store = makeStore(2, {0:([0, 0, 0], [0, 0, 0], 0)})
+    decoded = plugin.decodeSnapshot(plugin.encodeSnapshot(1.0, store, 1, flags=plugin.FS_FLAG_REPLAY))
+    assert decoded["keyframe"] and decoded["replay"]
+
+def test_delta_with_departed_seat(plugin, makeStore):
+    store = makeStore(4, {0:([1, 2, 3], [0, 0, 0], 10), 1:([4, 5, 6], [0, 0, 0], 20)})
+    #seat 2 left since the baseline, seat 1 didn't change
+    changed = (1<<0)|(1<<2)
+    payload = plugin.encodeSnapshot(3.0, store, 9, 8, changed)
+    decoded = plugin.decodeSnapshot(payload)
+
+    assert not decoded["keyframe"]
+    assert decoded["baseline"] == 8
+    assert sorted(decoded["delta"].keys()) == [0, 2]
+    assertSeat(plugin, decoded["delta"][0], [1, 2, 3], [0, 0, 0], 10)
+    assert decoded["delta"][2]["seat"] == -1
+    #only present and changed seats carry a record
+    assert len(payload) == plugin.FS_HEADER.size+plugin.FS_SEAT.size
+
+@pytest.mark.parametrize("angle, expected", [(180.0, -180.0), (-180.0, -180.0), (190.0, -170.0), (-190.0, 170.0), (359.0, -1.0), (720.5, 0.5)])
+def test_angle_wrap(plugin, makeStore, angle, expected):
+    store = makeStore(1, {0:([0, 0, 0], [angle, 0, 0], 0)})
+    decoded = plugin.decodeSnapshot(plugin.encodeSnapshot(0.0, store, 1))
+    assert decoded["states"][0]["orientation"][0] == pytest.approx(expected, abs=1/plugin.FS_ORIENTATION_SCALE)
+
+@pytest.mark.parametrize("rssi, expected", [(-5, 0), (0, 0), (65535, 65535), (70000, 65535)])
+def test_rssi_clamp(plugin, makeStore, rssi, expected):
+    store = makeStore(1, {0:([0, 0, 0], [0, 0, 0], rssi)})
+    assert plugin.decodeSnapshot(plugin.encodeSnapshot(0.0, store, 1))["states"][0]["rssi"] == expected
+
+def test_position_clamp(plugin, makeStore):
+    store = makeStore(1, {0:([3e6, -3e6, 1e12], [0, 0, 0], 0)})
+    limit = plugin.FS_MAX_POSITION/plugin.FS_POSITION_SCALE
+    assert plugin.decodeSnapshot(plugin.encodeSnapshot(0.0, store, 1))["states"][0]["position"] == pytest.approx([limit, -limit, limit])
+
+@pytest.mark.parametrize("field, value", [("position", [float("nan"), 0, 0]), ("orientation", [0, float("inf"), 0]), ("rssi", float("nan"))])
+def test_non_finite_state_is_rejected(plugin, makeStore, field, value):
+    store = makeStore(1, {0:([1, 2, 3], [4, 5, 6], 7)})
+    data = {"position":[0, 0, 0], "orientation":[0, 0, 0], "rssi":0}
+    data[field] = value
+    assert not store.update(0, data, 1.0)
+    assert list(store.position) == [1, 2, 3]
+    assert store.updateTimes[0] == 0.0
+
+def test_version_mismatch(plugin, makeStore):
+    store = makeStore(1, {0:([0, 0, 0], [0, 0, 0], 0)})
+    payload = bytearray(plugin.encodeSnapshot(0.0, store, 1))
+    struct.pack_into("<B", payload, 2, plugin.FS_WIRE_VERSION-1)
+    with pytest.raises(ValueError):
+        plugin.decodeSnapshot(bytes(payload))
+    with pytest.raises(ValueError):
+        plugin.decodeSnapshot(b"XX"+bytes(payload[2:]))
+
+@pytest.mark.parametrize("staleness, expected", [(0.0, 0), (123.7, 123), (70000.0, 65535)])
+def test_staleness_round_trip(plugin, makeStore, staleness, expected):
+    store = makeStore(2, {0:([0, 0, 0], [0, 0, 0], 0), 1:([0, 0, 0], [0, 0, 0], 0)})
+    store.staleness[0] = staleness
+    decoded = plugin.decodeSnapshot(plugin.encodeSnapshot(0.0, store, 1))
+    assert decoded["states"][0]["staleness"] == expected
+    assert decoded["states"][1]["staleness"] == 0
+    assert store.jsonState(0)["staleness"] == int(staleness)
+
+def test_seat_record_size(plugin, makeStore):
+    #v3 seat records carry staleness after rssi
+    store = makeStore(3, {0:([0, 0, 0], [0, 0, 0], 0), 2:([0, 0, 0], [0, 0, 0], 0)})
+    payload = plugin.encodeSnapshot(0.0, store, 1)
+    assert plugin.FS_WIRE_VERSION == 3
+    assert plugin.FS_SEAT.size == 22
+    assert len(payload) == plugin.FS_HEADER.size+2*plugin.FS_SEAT.size